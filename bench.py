@@ -0,0 +1,286 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import subprocess
+import tempfile
+import threading
+import json
+import http.client
+from http.server import HTTPServer
+from contextlib import suppress, redirect_stdout
+from c import File, PieceRegistry, Peer, AsyncPeer
+from t import TrackerHTTPServer, ThreadedTrackerServer
+from torrent import encode_torrent, decode_torrent, torrent_to_json
+
+
+def bench_hashing(path, workers=None):
+    workers = workers or os.cpu_count() or 1
+    handle_file = File(path, 'bench')
+    handle_file.show_progress = lambda *args: None
+    file_data = handle_file.layout_pieces()
+    total_size = sum(piece['length'] for piece in file_data['pieces'])
+    results = {}
+    for label, count in (('serial', 1), (f'parallel x{workers}', workers)):
+        start = time.perf_counter()
+        pieces_hash = ''.join(handle_file.hash_pieces(file_data['pieces'], count))
+        elapsed = time.perf_counter() - start
+        results[label] = pieces_hash
+        print(f"{label:<16} {len(file_data['pieces'])} pieces {elapsed:8.3f}s {total_size / elapsed / 2**20:10.1f} MiB/s")
+    if len(set(results.values())) != 1:
+        raise ValueError("Parallel pieces hash does not match the serial one")
+    print("pieces hash identical")
+
+
+def bench_lookup(pieces_per_torrent=100, lookups=20000):
+    print(f"{'torrents':>8} {'list scan':>12} {'registry':>12}")
+    for torrent_count in (1, 10, 100, 1000):
+        files = []
+        registry = PieceRegistry()
+        for t in range(torrent_count):
+            files.append({f'torrent-{t}': {str(i): 102400 for i in range(pieces_per_torrent)}})
+            registry.add(f'torrent-{t}', {i: 102400 for i in range(pieces_per_torrent)})
+        requests = [(f'torrent-{random.randrange(torrent_count)}', random.randrange(pieces_per_torrent)) for _ in range(lookups)]
+
+        start = time.perf_counter()
+        for filename, index in requests:
+            for each in files:
+                if filename in each:
+                    each[filename].get(str(index))
+                    break
+        scan = (time.perf_counter() - start) / lookups
+
+        start = time.perf_counter()
+        for filename, index in requests:
+            registry.get(filename, index)
+        indexed = (time.perf_counter() - start) / lookups
+        print(f"{torrent_count:>8} {scan * 1e6:>10.2f}us {indexed * 1e6:>10.2f}us")
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def bench_peers(size_mb=64, engine=None, port=7100):
+    if engine is None:
+        print(f"{'engine':<10} {'seconds':>8} {'MiB/s':>8} {'peak threads':>13} {'peak RSS MiB':>13}")
+        for offset, engine in enumerate(('threaded', 'asyncio')):
+            # Separate ports, so sockets left in TIME_WAIT by one run do not block the next.
+            subprocess.run([sys.executable, os.path.abspath(__file__), 'peers', str(size_mb), engine, str(port + offset * 2)], check=True)
+        return
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(size_mb * 2**20))
+        path = f.name
+    size = os.path.getsize(path)
+    cls = {'threaded': Peer, 'asyncio': AsyncPeer}[engine]
+    try:
+        seeder = cls(port)
+        seeder.daemon = True
+        seeder.store.add_torrent('bench', seeder.handle_file.piece_size, [(path, size)])
+        piece_count = seeder.store.piece_count('bench')
+        seeder.files.add('bench', {i: seeder.store.piece_length('bench', i) for i in range(piece_count)})
+        seeder.start()
+        time.sleep(0.5)
+        leecher = cls(port + 1)
+        spool_path = path + '.download'
+        leecher.store.add_torrent('bench', leecher.handle_file.piece_size, [(spool_path, size)])
+        peak = {'threads': 0, 'rss': 0}
+        done = threading.Event()
+
+        def monitor():
+            while not done.is_set():
+                peak['threads'] = max(peak['threads'], threading.active_count())
+                peak['rss'] = max(peak['rss'], current_rss())
+                time.sleep(0.01)
+        threading.Thread(target=monitor, daemon=True).start()
+
+        start = time.perf_counter()
+        info = {'bench': {}}
+        if cls is Peer:
+            ok = leecher.scheduler.run('bench', {str(i): [[seeder.peer_ip, port]] for i in range(piece_count)}, info)
+        else:
+            async def fetch_all():
+                await leecher.prepare()
+                results = await asyncio.gather(*(leecher.fetch_piece('bench', str(i), [[seeder.peer_ip, port]], info) for i in range(piece_count)))
+                for connection in leecher.async_connections.values():
+                    connection.close()
+                return all(results)
+            ok = asyncio.run(fetch_all())
+        elapsed = time.perf_counter() - start
+        done.set()
+        leecher.connections.close_all()
+        seeder.stop()
+        seeder.join()
+        if not ok:
+            raise ValueError(f"{engine} transfer failed")
+        if ''.join(info['bench'][str(i)] for i in range(piece_count)) != ''.join(seeder.handle_file.calculate_sha1(seeder.store.read('bench', i, 0, seeder.handle_file.piece_size)) for i in range(piece_count)):
+            raise ValueError(f"{engine} transfer corrupted the data")
+        print(f"{engine:<10} {elapsed:>8.2f} {size / elapsed / 2**20:>8.1f} {peak['threads']:>13} {peak['rss'] / 2**20:>13.1f}")
+    finally:
+        os.remove(path)
+        with suppress(FileNotFoundError):
+            os.remove(path + '.download')
+
+
+def bench_tracker(clients=64, requests_per_client=100, torrents=20, pieces=200, port=7200):
+    print(f"{'server':<10} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    TrackerHTTPServer.log_message = lambda *args: None
+    for offset, (label, server_class) in enumerate((('single', HTTPServer), ('threaded', ThreadedTrackerServer))):
+        TrackerHTTPServer.registry = {}
+        TrackerHTTPServer.peer_files = {}
+        TrackerHTTPServer.last_seen = {}
+        httpd = server_class(('127.0.0.1', port + offset), TrackerHTTPServer)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+
+        def post(connection, path, body):
+            connection.request('POST', path, json.dumps(body), {'Content-Type': 'application/json'})
+            return connection.getresponse()
+
+        def client(n):
+            connection = http.client.HTTPConnection('127.0.0.1', port + offset, timeout=30)
+            for i in range(requests_per_client):
+                name = f'torrent-{random.randrange(torrents)}'
+                indices = random.sample(range(pieces), 20)
+                start = time.perf_counter()
+                try:
+                    if i % 4 == 0:
+                        response = post(connection, '/peer-update', {'file_name': name, 'peer_ip': '10.0.0.1', 'peer_port': n, 'pieces_indices': indices})
+                    else:
+                        connection.request('GET', f"/get-peer?filename={name}&piece_indices={','.join(map(str, indices))}")
+                        response = connection.getresponse()
+                    response.read()
+                    ok = response.status == 200
+                except (OSError, http.client.HTTPException):
+                    ok = False
+                # BaseHTTPRequestHandler speaks HTTP/1.0, so every request needs a fresh connection.
+                connection.close()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    errors[0] += not ok
+
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        httpd.shutdown()
+        httpd.server_close()
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"{label:<10} {len(latencies):>9} {len(latencies) / elapsed:>9.0f} {p50 * 1000:>8.1f} {p99 * 1000:>8.1f} {errors[0]:>7}")
+
+
+def bench_swarm(pieces=100000, share=0.02, seeds=0.1, queries=20):
+    import tracemalloc
+    print(f"{pieces} pieces, {seeds:.0%} of peers seeding, the rest holding {share:.0%}")
+    print(f"{'registry':<8} {'peers':>6} {'announce ms':>12} {'query 100 ms':>13} {'all+json ms':>13} {'memory MiB':>11}")
+    tracker = TrackerHTTPServer.__new__(TrackerHTTPServer)
+    for peers in (100, 1000, 3000):
+        announces = [(f'10.0.{n // 256}.{n % 256}', 5000, list(range(pieces)) if n < peers * seeds else random.sample(range(pieces), int(pieces * share))) for n in range(peers)]
+        samples = [random.sample(range(pieces), 100) for _ in range(queries)]
+        for label in ('lists', 'bitmap'):
+            if label == 'lists' and peers > 1000:
+                # The list registry takes minutes to build at this size.
+                continue
+            tracemalloc.start()
+            start = time.perf_counter()
+            if label == 'lists':
+                registry = {}
+                for peer_ip, peer_port, indices in announces:
+                    for index in indices:
+                        holders = registry.setdefault(index, [])
+                        if (peer_ip, peer_port) not in holders:
+                            holders.append((peer_ip, peer_port))
+                query = lambda indices: {index: registry.get(index, []) for index in indices}
+            else:
+                TrackerHTTPServer.registry = {'bench': TrackerHTTPServer.new_file()}
+                TrackerHTTPServer.peer_ids = {}
+                TrackerHTTPServer.peer_addresses = []
+                TrackerHTTPServer.peer_files = {}
+                TrackerHTTPServer.last_seen = {}
+                for peer_ip, peer_port, indices in announces:
+                    tracker.add_pieces('bench', peer_ip, peer_port, indices)
+                query = lambda indices: tracker.find_peers_by_piece_indices('bench', indices)
+            announce = (time.perf_counter() - start) / peers
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            start = time.perf_counter()
+            for indices in samples:
+                query(indices)
+            small = (time.perf_counter() - start) / queries
+            start = time.perf_counter()
+            json.dumps(query(range(pieces)))
+            full = time.perf_counter() - start
+            print(f"{label:<8} {peers:>6} {announce * 1000:>12.3f} {small * 1000:>13.2f} {full * 1000:>13.0f} {memory / 2**20:>11.1f}")
+            registry = None
+            TrackerHTTPServer.registry = {}
+
+
+def bench_torrent(pieces=1000000, lookups=100000):
+    import tracemalloc
+    torrent_data = {
+        'announce': 'http://127.0.0.1:8000',
+        'info': {'piece length': 102400, 'name': 'bench', 'length': pieces * 102400, 'pieces': os.urandom(pieces * 20).hex()},
+    }
+    encoded = {'json': json.dumps(torrent_data).encode(), 'binary': encode_torrent(torrent_data)}
+    loaders = {'json': json.loads, 'binary': decode_torrent}
+    getters = {'json': lambda hashes, index: hashes[index * 40:(index + 1) * 40], 'binary': lambda hashes, index: hashes[index]}
+    indices = [random.randrange(pieces) for _ in range(lookups)]
+    print(f"{pieces} pieces")
+    print(f"{'format':<8} {'MiB':>8} {'load ms':>9} {'load MiB':>9} {'lookup us':>10}")
+    for label, data in encoded.items():
+        tracemalloc.start()
+        start = time.perf_counter()
+        loaded = loaders[label](data)
+        elapsed = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        hashes = loaded['info']['pieces']
+        get = getters[label]
+        start = time.perf_counter()
+        for index in indices:
+            get(hashes, index)
+        lookup = (time.perf_counter() - start) / lookups
+        print(f"{label:<8} {len(data) / 2**20:>8.1f} {elapsed * 1000:>9.1f} {memory / 2**20:>9.1f} {lookup * 1e6:>10.3f}")
+    if torrent_to_json(decode_torrent(encoded['binary'])) != torrent_data:
+        raise ValueError("Binary torrent does not round trip to the JSON one")
+    print("round trip identical")
+
+
+def main():
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ''
+    if cmd == 'hash' and len(sys.argv) > 2:
+        bench_hashing(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    elif cmd == 'lookup':
+        bench_lookup()
+    elif cmd == 'peers':
+        bench_peers(int(sys.argv[2]) if len(sys.argv) > 2 else 64, sys.argv[3] if len(sys.argv) > 3 else None, int(sys.argv[4]) if len(sys.argv) > 4 else 7100)
+    elif cmd == 'swarm':
+        bench_swarm()
+    elif cmd == 'torrent':
+        bench_torrent(int(sys.argv[2]) if len(sys.argv) > 2 else 1000000)
+    elif cmd == 'tracker':
+        bench_tracker(int(sys.argv[2]) if len(sys.argv) > 2 else 64)
+    else:
+        print("usage: python bench.py hash <path> [workers]")
+        print("       python bench.py lookup")
+        print("       python bench.py peers [size_mb] [threaded|asyncio] [port]")
+        print("       python bench.py tracker [clients]")
+        print("       python bench.py swarm")
+        print("       python bench.py torrent [pieces]")
+
+if __name__ == "__main__":
+    main()
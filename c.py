@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import threading
 import socket
@@ -8,14 +9,27 @@ import math
 import json
 import pprint
 import random
+import bisect
+import struct
+import heapq
+import queue
+import sys
+import base64
+import pickle
 from contextlib import suppress
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
 
 
 TRACKER_URL = 'http://192.168.100.6:8000' 
+BIT_POSITIONS = [tuple(bit for bit in range(8) if byte & (0x80 >> bit)) for byte in range(256)]
 class File: 
     def __init__(self, path: str, ip):
         self.piece_size = 102400
         self.block_size = self.piece_size // 2
+        self.hash_workers = 1
+        self.block_roots = True
+        self.hash_cache = None
         self.path = path
         self.peer_ip = ip
 
@@ -27,7 +41,176 @@ class File:
         sha1_digest = sha1_hash.hexdigest()
         return sha1_digest
 
-    def divide_file_into_pieces(self):
+    def list_files(self):
+        name = os.path.basename(self.path)
+        if os.path.isdir(self.path):
+            entries = []
+            for root, dirs, files in os.walk(self.path):
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    relative_path = os.path.relpath(file_path, start=self.path)
+                    entries.append((file_path, os.path.join(name, relative_path), os.path.getsize(file_path)))
+            return entries
+        elif os.path.isfile(self.path):
+            return [(self.path, name, os.path.getsize(self.path))]
+        raise ValueError("Provided path is neither a file nor a directory.")
+
+    def read_spans(self, spans, offset=0, size=None):
+        data = bytearray()
+        size = sum(length for _, _, length in spans) - offset if size is None else size
+        for file_path, file_offset, length in spans:
+            if offset >= length:
+                offset -= length
+                continue
+            if size <= 0:
+                break
+            with open(file_path, 'rb') as f:
+                f.seek(file_offset + offset)
+                chunk = f.read(min(length - offset, size))
+            data.extend(chunk)
+            size -= len(chunk)
+            offset = 0
+        return data
+
+    def piece_length(self, piece):
+        if isinstance(piece, dict):
+            return piece['length']
+        return len(piece)
+
+    def hash_piece(self, piece):
+        if isinstance(piece, dict):
+            return self.calculate_sha1(self.read_spans(piece['spans']))
+        return self.calculate_sha1(piece)
+
+    def hash_piece_blocks(self, piece):
+        data = self.read_spans(piece['spans']) if isinstance(piece, dict) else piece
+        return self.calculate_sha1(data), BlockTree.leaves(data, self.block_size)
+
+    def hash_pieces(self, pieces, workers=1, blocks=False):
+        hash_piece = self.hash_piece_blocks if blocks else self.hash_piece
+        if workers <= 1:
+            return [hash_piece(piece) for piece in pieces]
+        hashes = []
+        batch_size = workers * 4
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i in range(0, len(pieces), batch_size):
+                hashes.extend(executor.map(hash_piece, pieces[i:i + batch_size]))
+        return hashes
+
+    def layout_pieces(self):
+        name = os.path.basename(self.path)
+        entries = self.list_files()
+        pieces = []
+        file_info = {}
+        piece_mappings = []
+        current_offset = 0
+        spans = []
+        piece_offset = 0
+        filled = 0
+        for file_path, full_path, file_size in entries:
+            file_info[full_path] = file_size
+            if os.path.isdir(self.path):
+                piece_mappings.append({
+                    'file_path': full_path,
+                    'start_piece': current_offset // self.piece_size,
+                    'end_piece': (current_offset + file_size - 1) // self.piece_size,
+                    'start_offset': current_offset,
+                    'end_offset': (current_offset + file_size - 1)
+                })
+            file_offset = 0
+            while file_offset < file_size:
+                length = min(self.piece_size - filled, file_size - file_offset)
+                spans.append((file_path, file_offset, length))
+                file_offset += length
+                filled += length
+                if filled == self.piece_size:
+                    pieces.append({'offset': piece_offset, 'length': filled, 'spans': spans})
+                    piece_offset += filled
+                    spans = []
+                    filled = 0
+            current_offset += file_size
+        if filled:
+            pieces.append({'offset': piece_offset, 'length': filled, 'spans': spans})
+        return {
+            'name': name,
+            'pieces': pieces,
+            'info': {
+                'file_info': file_info,
+                'piece_mappings': piece_mappings
+            }
+        }
+
+    def stream_pieces(self):
+        # Only used by a File with one hash worker and no hash cache. Peer always sets a
+        # hash cache, so uploads go through layout_pieces and apply_hash_cache instead.
+        name = os.path.basename(self.path)
+        entries = self.list_files()
+        total_size = sum(file_size for _, _, file_size in entries)
+        pieces = []
+        file_info = {}
+        piece_mappings = []
+        current_offset = 0
+        sha1_hash = hashlib.sha1()
+        block_hash = hashlib.sha1()
+        blocks = []
+        spans = []
+        piece_offset = 0
+        filled = 0
+        for file_path, full_path, file_size in entries:
+            file_info[full_path] = file_size
+            if os.path.isdir(self.path):
+                piece_mappings.append({
+                    'file_path': full_path,
+                    'start_piece': current_offset // self.piece_size,
+                    'end_piece': (current_offset + file_size - 1) // self.piece_size,
+                    'start_offset': current_offset,
+                    'end_offset': (current_offset + file_size - 1)
+                })
+            with open(file_path, 'rb') as f:
+                file_offset = 0
+                while file_offset < file_size:
+                    # Reads stop at block boundaries so every block gets its own hash too.
+                    chunk = f.read(min(self.piece_size - filled, self.block_size - filled % self.block_size))
+                    if not chunk:
+                        break
+                    sha1_hash.update(chunk)
+                    spans.append((file_path, file_offset, len(chunk)))
+                    file_offset += len(chunk)
+                    filled += len(chunk)
+                    if self.block_roots:
+                        block_hash.update(chunk)
+                        if filled % self.block_size == 0 or filled == self.piece_size:
+                            blocks.append(block_hash.digest())
+                            block_hash = hashlib.sha1()
+                    if filled == self.piece_size:
+                        pieces.append({'offset': piece_offset, 'length': filled, 'spans': spans, 'hash': sha1_hash.hexdigest(), 'blocks': blocks})
+                        piece_offset += filled
+                        sha1_hash = hashlib.sha1()
+                        blocks = []
+                        spans = []
+                        filled = 0
+            current_offset += file_size
+            self.show_progress(name, current_offset, total_size)
+        if filled:
+            if self.block_roots and filled % self.block_size:
+                blocks.append(block_hash.digest())
+            pieces.append({'offset': piece_offset, 'length': filled, 'spans': spans, 'hash': sha1_hash.hexdigest(), 'blocks': blocks})
+        return {
+            'name': name,
+            'pieces': pieces,
+            'info': {
+                'file_info': file_info,
+                'piece_mappings': piece_mappings
+            }
+        }
+
+    def divide_file_into_pieces(self, stream=False):
+        if stream:
+            # With a hash cache, pieces are only read when create_torrent_file misses it, and
+            # with several workers they are hashed in parallel; either way nothing is read here.
+            if self.hash_workers > 1 or self.hash_cache is not None:
+                return self.layout_pieces()
+            return self.stream_pieces()
         name = os.path.basename(self.path)
         pieces = []
         total_data = bytearray()
@@ -92,8 +275,38 @@ class File:
             print()
         time.sleep(0.5) 
 
+    def apply_hash_cache(self, pieces):
+        self.hash_cache.stats.clear()
+        missing = []
+        keys = []
+        for piece in pieces:
+            key = self.hash_cache.key(piece['spans'], self.piece_size, self.block_size)
+            cached = self.hash_cache.get(key)
+            if cached:
+                piece['hash'], piece['blocks'] = cached
+            else:
+                missing.append(piece)
+                keys.append(key)
+        for piece, key, (digest, blocks) in zip(missing, keys, self.hash_pieces(missing, self.hash_workers, blocks=True)):
+            piece['hash'], piece['blocks'] = digest, blocks
+            self.hash_cache.put(key, digest, blocks)
+        self.hash_cache.save()
+        print(f"\033[34mReused {len(pieces) - len(missing)} of {len(pieces)} piece hashes, hashed {len(missing)}\033[0m")
+
     def create_torrent_file(self, file_data):
-        pieces_hash = ''.join([self.calculate_sha1(piece) for piece in file_data['pieces']])
+        pieces = file_data['pieces']
+        if self.hash_cache is not None and all(isinstance(piece, dict) for piece in pieces):
+            self.apply_hash_cache(pieces)
+        if all(isinstance(piece, dict) and 'hash' in piece and (piece.get('blocks') or not self.block_roots) for piece in pieces):
+            digests = [(piece['hash'], piece.get('blocks')) for piece in pieces]
+        elif self.block_roots:
+            digests = self.hash_pieces(pieces, self.hash_workers, blocks=True)
+            for piece, (digest, blocks) in zip(pieces, digests):
+                if isinstance(piece, dict):
+                    piece['hash'], piece['blocks'] = digest, blocks
+        else:
+            digests = [(digest, None) for digest in self.hash_pieces(pieces, self.hash_workers)]
+        pieces_hash = ''.join(digest for digest, _ in digests)
         torrent_data = {
             'announce': TRACKER_URL,
             'info': {
@@ -101,6 +314,10 @@ class File:
                 'pieces': pieces_hash
             }
         }
+        if self.block_roots:
+            # One Merkle root per piece over its blocks, hex encoded like 'pieces'.
+            torrent_data['info']['block length'] = self.block_size
+            torrent_data['info']['block roots'] = ''.join(BlockTree(blocks).root.hex() for _, blocks in digests)
         if 'piece_mappings' in file_data['info'] and len(file_data['info']['piece_mappings']) > 0 :
             torrent_data['info']['files'] = []
             torrent_data['info']['name'] = file_data['name'] 
@@ -127,6 +344,701 @@ class File:
 
 
 
+class PieceStore:
+    def __init__(self):
+        self.torrents = {}
+        self.lock = threading.Lock()
+
+    def add_torrent(self, name, piece_length, files):
+        layout = {'piece_length': piece_length, 'starts': [], 'files': [], 'total': 0}
+        for path, length in files:
+            if length == 0:
+                continue
+            layout['starts'].append(layout['total'])
+            layout['files'].append((path, length))
+            layout['total'] += length
+        with self.lock:
+            self.torrents[name] = layout
+        return layout
+
+    def has_torrent(self, name):
+        return name in self.torrents
+
+    def piece_count(self, name):
+        layout = self.torrents[name]
+        return math.ceil(layout['total'] / layout['piece_length'])
+
+    def piece_length(self, name, index):
+        layout = self.torrents[name]
+        start = index * layout['piece_length']
+        return max(0, min(layout['piece_length'], layout['total'] - start))
+
+    def spans(self, name, index, offset, size):
+        layout = self.torrents[name]
+        start = index * layout['piece_length'] + offset
+        end = min(start + size, (index + 1) * layout['piece_length'], layout['total'])
+        i = max(0, bisect.bisect_right(layout['starts'], start) - 1)
+        while start < end and i < len(layout['files']):
+            path, length = layout['files'][i]
+            file_offset = start - layout['starts'][i]
+            count = min(length - file_offset, end - start)
+            if count > 0:
+                yield path, file_offset, count
+                start += count
+            i += 1
+
+    def read(self, name, index, offset, size):
+        data = bytearray()
+        for path, file_offset, count in self.spans(name, index, offset, size):
+            with open(path, 'rb') as f:
+                if hasattr(os, 'pread'):
+                    data.extend(os.pread(f.fileno(), count, file_offset))
+                else:
+                    f.seek(file_offset)
+                    data.extend(f.read(count))
+        return data
+
+    def send(self, sock, name, index, offset, size):
+        sent = 0
+        for path, file_offset, count in self.spans(name, index, offset, size):
+            with open(path, 'rb') as f:
+                sent += sock.sendfile(f, file_offset, count)
+        return sent
+
+    def allocate(self, name, indices, only=None):
+        paths = {path for index in indices for path, _, _ in self.spans(name, index, 0, self.piece_length(name, index))}
+        for path, length in self.torrents[name]['files']:
+            if path not in paths or (only is not None and path not in only):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                if f.tell() < length:
+                    f.truncate(length)
+
+    def write(self, name, index, data):
+        offset = 0
+        for path, file_offset, count in self.spans(name, index, 0, len(data)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+                if hasattr(os, 'pwrite'):
+                    os.pwrite(f.fileno(), data[offset:offset + count], file_offset)
+                else:
+                    f.seek(file_offset)
+                    f.write(data[offset:offset + count])
+            offset += count
+
+
+class PieceRegistry:
+    def __init__(self):
+        self.pieces = {}
+        self.torrents = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, pieces):
+        with self.lock:
+            indices = self.torrents.setdefault(name, set())
+            for index, length in pieces.items():
+                self.pieces[(name, index)] = length
+                indices.add(index)
+
+    def get(self, name, index):
+        # A single dict lookup is atomic, so readers never wait on writers.
+        return self.pieces.get((name, index))
+
+    def has_torrent(self, name):
+        return name in self.torrents
+
+    def torrent_pieces(self, name):
+        with self.lock:
+            return {index: self.pieces[(name, index)] for index in self.torrents.get(name, ())}
+
+
+class Bitfield:
+    def __init__(self, path, count, key):
+        self.path = path
+        self.count = count
+        self.key = hashlib.sha1(key.encode()).digest()
+        self.lock = threading.Lock()
+        size = len(self.key) + math.ceil(count / 8)
+        data = b''
+        with suppress(FileNotFoundError):
+            with open(path, 'rb') as f:
+                data = f.read()
+        if len(data) != size or not data.startswith(self.key):
+            # Missing, truncated or left over from another torrent with the same name.
+            data = self.key + bytes(size - len(self.key))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        self.bits = bytearray(data[len(self.key):])
+
+    def has(self, index):
+        return bool(self.bits[index // 8] & (0x80 >> index % 8))
+
+    def set(self, index):
+        with self.lock:
+            if self.has(index):
+                return
+            self.bits[index // 8] |= 0x80 >> index % 8
+            with open(self.path, 'r+b') as f:
+                f.seek(len(self.key) + index // 8)
+                f.write(self.bits[index // 8:index // 8 + 1])
+
+    def indices(self):
+        return [index for index in range(self.count) if self.has(index)]
+
+
+class HashCache:
+    # Piece digests from earlier uploads, keyed by the piece and block size and
+    # by (path, size, mtime, offset, length) of every file span in the piece,
+    # so a piece is only reused while all the files it covers are unchanged.
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        with suppress(OSError, EOFError, pickle.UnpicklingError, ValueError):
+            with open(path, 'rb') as f:
+                self.entries = pickle.load(f)
+
+    def stat(self, path):
+        if path not in self.stats:
+            try:
+                stat = os.stat(path)
+                self.stats[path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                self.stats[path] = None
+        return self.stats[path]
+
+    def key(self, spans, piece_size, block_size):
+        files = []
+        for file_path, file_offset, length in spans:
+            file_path = os.path.abspath(file_path)
+            files.append((file_path, self.stat(file_path), file_offset, length))
+        return (piece_size, block_size, tuple(files))
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, digest, blocks):
+        with self.lock:
+            self.entries[key] = (digest, blocks)
+
+    def save(self):
+        with self.lock:
+            # Entries for files that changed or disappeared can never match again.
+            self.entries = {key: value for key, value in self.entries.items() if all(self.stat(path) == stat for path, stat, _, _ in key[2])}
+            self.stats = {}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                # Peers started from the same directory share the cache file.
+                temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'wb') as f:
+                    pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                print(f"\033[31mCould not save the hash cache to {self.path}: {e}\033[0m")
+
+
+class BlockTree:
+    # SHA-1 Merkle tree over the blocks of one piece, leaves first. A node
+    # without a sibling is carried up to the next level unchanged.
+    def __init__(self, leaves):
+        self.levels = [list(leaves)]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            self.levels.append([hashlib.sha1(level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)])
+
+    @staticmethod
+    def leaves(data, block_size):
+        view = memoryview(data)
+        return [hashlib.sha1(view[offset:offset + block_size]).digest() for offset in range(0, len(view), block_size)]
+
+    @property
+    def root(self):
+        return self.levels[-1][0]
+
+    def proof(self, index):
+        proof = []
+        for level in self.levels[:-1]:
+            if index ^ 1 < len(level):
+                proof.append(level[index ^ 1])
+            index //= 2
+        return proof
+
+    @staticmethod
+    def verify(leaf, index, count, proof, root):
+        if not 0 <= index < count:
+            return False
+        proof = iter(proof)
+        node = leaf
+        while count > 1:
+            if index ^ 1 < count:
+                sibling = next(proof, None)
+                if sibling is None:
+                    return False
+                node = hashlib.sha1(node + sibling if index % 2 == 0 else sibling + node).digest()
+            index //= 2
+            count = (count + 1) // 2
+        return next(proof, None) is None and node == root
+
+
+class PeerProtocol:
+    MAGIC = 0xB7
+    VERSION = 2
+    HELLO = 0
+    LENGTH = 1
+    BLOCK = 2
+    ERROR = 3
+    # Since version 2: a BLOCK request whose reply carries the block followed
+    # by its Merkle proof, with the block size in the length field.
+    BLOCK_PROOF = 4
+    header = struct.Struct('!BBBIIII')
+
+    def __init__(self, sock, version=VERSION):
+        self.sock = sock
+        self.version = version
+
+    def pack(self, msg_type, index=0, offset=0, length=0, payload_length=0):
+        return self.header.pack(self.MAGIC, self.version, msg_type, index, offset, length, payload_length)
+
+    def send(self, msg_type, index=0, offset=0, length=0, payload=b''):
+        self.sock.sendall(self.pack(msg_type, index, offset, length, len(payload)) + payload)
+
+    def recv_exact(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(min(size - len(data), 65536))
+            if not chunk:
+                raise ConnectionError(f"Connection closed after {len(data)} of {size} bytes")
+            data.extend(chunk)
+        return data
+
+    @classmethod
+    def unpack(cls, data):
+        magic, version, msg_type, index, offset, length, payload_length = cls.header.unpack(data)
+        if magic != cls.MAGIC:
+            raise ValueError(f"Invalid frame magic {magic:#x}")
+        return {'type': msg_type, 'version': version, 'index': index, 'offset': offset, 'length': length, 'payload_length': payload_length}
+
+    def recv(self):
+        frame = self.unpack(self.recv_exact(self.header.size))
+        payload_length = frame.pop('payload_length')
+        frame['payload'] = self.recv_exact(payload_length) if payload_length else bytearray()
+        return frame
+
+    def negotiate(self):
+        self.send(self.HELLO)
+        frame = self.recv()
+        if frame['type'] != self.HELLO:
+            raise ValueError(f"Expected HELLO, got message type {frame['type']}")
+        self.version = min(self.VERSION, frame['version'])
+        return self.version
+
+
+class PeerConnection:
+    def __init__(self, sock, protocol, depth, timeout=None):
+        self.sock = sock
+        self.protocol = protocol
+        self.pending = deque()
+        self.slots = threading.Semaphore(depth)
+        self.timeout = timeout
+        self.send_lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self.read_responses, daemon=True).start()
+
+    def request(self, msg_type, index=0, offset=0, length=0, payload=b''):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No request slot freed up within {self.timeout}s")
+        future = Future()
+        with self.send_lock:
+            if self.closed:
+                self.slots.release()
+                raise ConnectionError("Connection is closed")
+            self.pending.append(future)
+            try:
+                self.protocol.send(msg_type, index, offset, length, payload)
+            except OSError:
+                self.close()
+                raise
+        return future
+
+    def read_responses(self):
+        try:
+            while True:
+                frame = self.protocol.recv()
+                future = self.pending.popleft()
+                self.slots.release()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if frame['type'] == PeerProtocol.ERROR:
+                    future.set_exception(ValueError(frame['payload'].decode()))
+                else:
+                    future.set_result(frame)
+        except (OSError, ValueError, IndexError, struct.error):
+            self.close()
+
+    def close(self):
+        with self.send_lock:
+            self.closed = True
+            with suppress(OSError):
+                # shutdown wakes the reader thread, which close alone may leave blocked in recv.
+                self.sock.shutdown(socket.SHUT_RDWR)
+            with suppress(OSError):
+                self.sock.close()
+            while self.pending:
+                future = self.pending.popleft()
+                self.slots.release()
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(ConnectionError("Connection closed with requests in flight"))
+
+
+class PeerConnectionPool:
+    def __init__(self, peer, depth=8):
+        self.peer = peer
+        self.depth = depth
+        self.connections = {}
+        self.connect_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, peer_ip, peer_port):
+        key = (peer_ip, peer_port)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection and not connection.closed:
+                return connection
+            connect_lock = self.connect_locks.setdefault(key, threading.Lock())
+        # Connecting holds only this peer's lock, so a slow peer cannot stall requests to the others.
+        with connect_lock:
+            with self.lock:
+                connection = self.connections.get(key)
+                if connection and not connection.closed:
+                    return connection
+            if self.peer.peer_versions.get(key) == 0:
+                return None
+            sock, protocol = self.peer.connect_to_peer(peer_ip, peer_port)
+            if protocol is None:
+                return None
+            connection = PeerConnection(sock, protocol, self.depth, self.peer.request_timeout)
+            with self.lock:
+                self.connections[key] = connection
+            return connection
+
+    def close_all(self):
+        with self.lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+
+
+class PiecePicker:
+    def __init__(self, peer_set):
+        self.holders = {}
+        self.heap = []
+        self.pending = set()
+        self.completed = set()
+        self.lock = threading.Lock()
+        self.update(peer_set)
+        self.pending = set(self.holders)
+
+    def update(self, peer_set):
+        with self.lock:
+            for index, peer_ips in peer_set.items():
+                holders = self.holders.setdefault(index, [])
+                for value in peer_ips:
+                    if value not in holders:
+                        holders.append(value)
+                heapq.heappush(self.heap, (self.rank(index), random.random(), index))
+
+    def rank(self, index):
+        count = len(self.holders[index])
+        return count if count else math.inf
+
+    def pick(self):
+        with self.lock:
+            while self.heap:
+                rank, _, index = heapq.heappop(self.heap)
+                if index not in self.pending:
+                    continue
+                if rank != self.rank(index):
+                    heapq.heappush(self.heap, (self.rank(index), random.random(), index))
+                    continue
+                self.pending.discard(index)
+                return index
+            return None
+
+    def complete(self, index):
+        with self.lock:
+            self.completed.add(index)
+
+    def unfinished(self):
+        with self.lock:
+            return [index for index in self.holders if index not in self.completed]
+
+
+class PeerStats:
+    def __init__(self, explore=0.1, alpha=0.3):
+        self.explore = explore
+        self.alpha = alpha
+        self.peers = {}
+        self.lock = threading.Lock()
+
+    def entry(self, value):
+        return self.peers.setdefault(tuple(value), {'rtt': None, 'rate': None, 'failure_rate': 0.0, 'requests': 0, 'failures': 0, 'bytes': 0})
+
+    def record(self, value, elapsed, size):
+        elapsed = max(elapsed, 1e-6)
+        with self.lock:
+            stats = self.entry(value)
+            stats['requests'] += 1
+            stats['bytes'] += size
+            stats['rtt'] = elapsed if stats['rtt'] is None else (1 - self.alpha) * stats['rtt'] + self.alpha * elapsed
+            stats['rate'] = size / elapsed if stats['rate'] is None else (1 - self.alpha) * stats['rate'] + self.alpha * size / elapsed
+            stats['failure_rate'] *= 1 - self.alpha
+
+    def fail(self, value):
+        with self.lock:
+            stats = self.entry(value)
+            stats['requests'] += 1
+            stats['failures'] += 1
+            stats['failure_rate'] = (1 - self.alpha) * stats['failure_rate'] + self.alpha
+
+    def score(self, value, default=None):
+        stats = self.peers.get(tuple(value))
+        if stats is None or stats['rate'] is None:
+            return default
+        return stats['rate'] * (1 - stats['failure_rate'])
+
+    def order(self, candidates):
+        # Best scored peer first, with an occasional random pick so slow or
+        # unmeasured peers still get a share of requests and can improve.
+        candidates = random.sample(candidates, len(candidates))
+        if len(candidates) < 2 or random.random() < self.explore:
+            return candidates
+        with self.lock:
+            known = [score for score in (self.score(value) for value in candidates) if score is not None]
+            default = sum(known) / len(known) if known else 1.0
+            weights = [max(self.score(value, default), 1e-9) for value in candidates]
+        first = random.choices(range(len(candidates)), weights)[0]
+        rest = sorted(candidates[:first] + candidates[first + 1:], key=lambda value: weights[candidates.index(value)], reverse=True)
+        return [candidates[first]] + rest
+
+    def scores(self):
+        with self.lock:
+            return {f"{ip}:{port}": dict(stats, score=self.score((ip, port), 0.0)) for (ip, port), stats in self.peers.items()}
+
+
+class DownloadScheduler:
+    def __init__(self, peer, workers=16, per_torrent=16, per_peer=8, refresh_interval=5, endgame_threshold=16, endgame_copies=2, max_piece_retries=3):
+        self.peer = peer
+        self.workers = workers
+        self.refresh_interval = refresh_interval
+        self.endgame_threshold = endgame_threshold
+        self.endgame_copies = endgame_copies
+        self.max_piece_retries = max_piece_retries
+        self.redundant_bytes = {}
+        self.per_torrent = per_torrent
+        self.per_peer = per_peer
+        self.jobs = queue.Queue()
+        self.torrent_slots = {}
+        self.peer_slots = {}
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self.threads = []
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def run(self, name, peer_set, piece_info, piece_hashes='', refresh=None, block_roots=''):
+        self.start()
+        block_size = self.peer.handle_file.block_size
+        picker = PiecePicker(peer_set)
+        download = {'name': name, 'pieces': {}, 'remaining': 0, 'queued': 0, 'failed': False, 'done': threading.Event(),
+                    'piece_info': piece_info, 'picker': picker, 'hashes': piece_hashes, 'roots': block_roots, 'endgame': False, 'redundant_bytes': 0}
+        for piece_index in peer_set:
+            download['remaining'] += math.ceil(self.peer.store.piece_length(name, int(piece_index)) / block_size)
+        if download['remaining'] == 0:
+            return True
+        self.feed(download)
+        while not download['done'].wait(self.refresh_interval):
+            if refresh:
+                with suppress(Exception):
+                    picker.update(refresh(picker.unfinished()))
+        if download['endgame']:
+            print(f"\033[34mEndgame for {name} fetched {download['redundant_bytes']} redundant bytes\033[0m")
+        self.redundant_bytes[name] = download['redundant_bytes']
+        return not download['failed']
+
+    def feed(self, download):
+        picker = download['picker']
+        with self.lock:
+            while download['queued'] < self.workers * 2:
+                piece_index = picker.pick()
+                if piece_index is None:
+                    break
+                download['pieces'][piece_index] = {'blocks': {}, 'remaining': 0, 'retries': 0, 'inflight': {}}
+                self.queue_piece(download, piece_index)
+            if not download['endgame'] and not picker.pending and download['remaining'] <= self.endgame_threshold:
+                download['endgame'] = True
+                for piece_index, state in download['pieces'].items():
+                    for offset, inflight in state['inflight'].items():
+                        holders = picker.holders[piece_index]
+                        for _ in range(min(len(holders), self.endgame_copies) - inflight['jobs']):
+                            self.queue_job(download, piece_index, offset, inflight['length'])
+
+    def queue_piece(self, download, piece_index, pinned=None):
+        block_size = self.peer.handle_file.block_size
+        piece_size = self.peer.store.piece_length(download['name'], int(piece_index))
+        offsets = range(0, piece_size, block_size)
+        download['pieces'][piece_index]['remaining'] = len(offsets)
+        download['queued'] += len(offsets)
+        for offset in offsets:
+            self.queue_job(download, piece_index, offset, min(block_size, piece_size - offset), pinned)
+
+    def queue_job(self, download, piece_index, offset, length, pinned=None):
+        inflight = download['pieces'][piece_index]['inflight'].setdefault(offset, {'length': length, 'jobs': 0, 'holders': [], 'futures': []})
+        inflight['jobs'] += 1
+        holders = [pinned] if pinned else download['picker'].holders[piece_index]
+        self.jobs.put({'download': download, 'piece': piece_index, 'offset': offset, 'length': length, 'holders': holders, 'pinned': pinned is not None, 'inflight': inflight})
+
+    def acquire(self, name, holders, busy):
+        with self.lock:
+            torrent_slots = self.torrent_slots.setdefault(name, threading.Semaphore(self.per_torrent))
+            if not torrent_slots.acquire(blocking=False):
+                return None
+            holders = [value for value in holders if not self.peer.is_banned(value)]
+            candidates = [value for value in holders if value not in busy] or holders
+            for value in self.peer.peer_stats.order(candidates):
+                peer_slots = self.peer_slots.setdefault(tuple(value), threading.Semaphore(self.per_peer))
+                if peer_slots.acquire(blocking=False):
+                    busy.append(value)
+                    return value
+            torrent_slots.release()
+            return None
+
+    def release(self, name, value, busy):
+        with self.lock:
+            with suppress(ValueError):
+                busy.remove(value)
+            self.torrent_slots[name].release()
+            self.peer_slots[tuple(value)].release()
+            self.released.notify_all()
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            download = job['download']
+            inflight = job['inflight']
+            if download['failed'] or download['pieces'][job['piece']]['inflight'].get(job['offset']) is not inflight:
+                self.finish(job, None)
+                continue
+            if not any(not self.peer.is_banned(value) for value in job['holders']):
+                self.finish(job, None)
+                continue
+            value = self.acquire(download['name'], job['holders'], inflight['holders'])
+            if value is None:
+                self.jobs.put(job)
+                with self.released:
+                    self.released.wait(0.05)
+                continue
+            peer_ip, peer_port = value
+            root = download['roots'][int(job['piece']) * 40:(int(job['piece']) + 1) * 40]
+            try:
+                data = self.peer.request_block(peer_ip, peer_port, download['name'], job['piece'], job['offset'], job['length'], inflight['futures'], root)
+            except Exception:
+                data = None
+                if job['pinned']:
+                    job['holders'] = download['picker'].holders[job['piece']]
+                    job['pinned'] = False
+                elif download['pieces'][job['piece']]['inflight'].get(job['offset']) is inflight:
+                    with suppress(ValueError):
+                        job['holders'].remove(value)
+            finally:
+                self.release(download['name'], value, inflight['holders'])
+            if data is None and download['pieces'][job['piece']]['inflight'].get(job['offset']) is inflight:
+                self.jobs.put(job)
+            else:
+                self.finish(job, data, value)
+
+    def finish(self, job, data, source=None):
+        download = job['download']
+        piece = None
+        with self.lock:
+            state = download['pieces'][job['piece']]
+            inflight = job['inflight']
+            if state['inflight'].get(job['offset']) is not inflight:
+                if data is not None:
+                    download['redundant_bytes'] += len(data)
+                return
+            inflight['jobs'] -= 1
+            if data is None:
+                if inflight['jobs'] == 0:
+                    download['failed'] = True
+                    download['done'].set()
+                return
+            del state['inflight'][job['offset']]
+            for future in inflight['futures']:
+                if future.cancel():
+                    download['redundant_bytes'] += inflight['length']
+            state['blocks'][job['offset']] = (data, source)
+            state['remaining'] -= 1
+            if state['remaining'] == 0:
+                blocks = state['blocks']
+                piece = b''.join(blocks[offset][0] for offset in sorted(blocks))
+                state['blocks'] = {}
+        if piece is not None:
+            self.complete_piece(download, job['piece'], piece, blocks)
+        with self.lock:
+            download['remaining'] -= 1
+            download['queued'] -= 1
+            if download['remaining'] == 0:
+                download['done'].set()
+        self.feed(download)
+
+    def complete_piece(self, download, piece_index, piece, blocks):
+        name = download['name']
+        state = download['pieces'][piece_index]
+        expected = download['hashes'][int(piece_index) * 40:(int(piece_index) + 1) * 40]
+        digest = self.peer.store_piece(name, piece_index, piece, expected)
+        if digest:
+            for offset, (data, source) in state.pop('suspect', {}).items():
+                if piece[offset:offset + len(data)] != data:
+                    self.peer.penalise_peer(source)
+            download['piece_info'][name][piece_index] = digest
+            download['picker'].complete(piece_index)
+            return
+        print(f"\033[31mPiece {piece_index} of {name} failed its hash check, re-fetching it\033[0m")
+        holders = download['picker'].holders[piece_index]
+        sources = {tuple(source) for _, source in blocks.values()}
+        pinned = None
+        if len(sources) == 1:
+            self.peer.penalise_peer(next(iter(sources)))
+            others = [value for value in holders if tuple(value) not in sources]
+            if others:
+                holders[:] = others
+        else:
+            # Blocks came from several peers: fetch the retry from one holder
+            # and blame whoever sent blocks that differ from the verified piece.
+            state.setdefault('suspect', blocks)
+            candidates = [value for value in holders if not self.peer.is_banned(value)]
+            pinned = min(candidates, key=lambda value: (self.peer.peer_penalties.get(tuple(value), 0), random.random())) if candidates else None
+        with self.lock:
+            state['retries'] += 1
+            if state['retries'] > self.max_piece_retries:
+                download['failed'] = True
+                download['done'].set()
+                return
+            queued = download['queued']
+            self.queue_piece(download, piece_index, pinned)
+            download['remaining'] += download['queued'] - queued
+
+
 class Peer(threading.Thread):
     def __init__(self, port= 5000):
         super().__init__()
@@ -136,10 +1048,35 @@ class Peer(threading.Thread):
         self.server_socket = None
         self.running = True
         self.OUTPUT_PATH = os.path.join(os.getcwd(), 'output')
-        self.files = []
+        self.files = PieceRegistry()
+        self.peer_versions = {}
+        self.pipeline_depth = 8
+        self.request_timeout = 30
+        self.connections = PeerConnectionPool(self, self.pipeline_depth)
+        self.scheduler = DownloadScheduler(self)
+        self.peer_penalties = {}
+        self.max_penalties = 3
+        self.peer_stats = PeerStats()
+        self.trackers = set()
+        self.heartbeat_interval = 30
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat = None
+        self.store = PieceStore()
+        self.bitfields = {}
+        self.seeded = set()
+        self.requested_files = {}
+        # Merkle trees of recently served pieces, least recently used first.
+        self.block_trees = OrderedDict()
+        self.max_block_trees = 4096
+        self.block_trees_lock = threading.Lock()
         self.SERVER_IP = '192.168.100.6' # CHANGE THIS TO YOUR SERVER IP
         self.SERVER_PORT = 6000 # THIS SHOULD MATCH THE PORT IN s.py
+        self.TORRENT_SERVER_MAGIC = 0xB8 # Server.MAGIC in s.py
+        self.torrent_cache = {}
+        self.metadata_ttl = 60
         self.handle_file = File('', self.peer_ip)
+        self.handle_file.hash_workers = os.cpu_count() or 1
+        self.handle_file.hash_cache = HashCache(os.path.join(self.OUTPUT_PATH, '.hashes', 'pieces.pickle'))
 
     def run(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -170,21 +1107,49 @@ class Peer(threading.Thread):
             "peer_ip": self.peer_ip,
             "peer_port": self.port,
             "file_name": torrent_data['info']['name'],
-            "pieces_indices": list(range(number_of_pieces)),
+            "piece_ranges": self.encode_ranges(range(number_of_pieces)),
             "file_details": file_details
         }
         response = requests.post(torrent_data['announce'] + '/peer-update', json=payload)
         print(f'Peer {self.peer_ip}:{self.port} ' + response.text)
+        self.start_heartbeat(torrent_data['announce'])
         
     def update_tracker_download(self, torrent_data):
         payload = {
             "peer_ip": self.peer_ip,
             "peer_port": self.port,
             "file_name": torrent_data['file_name'],
-            "pieces_indices": torrent_data['pieces_indices'],
+            "piece_ranges": self.encode_ranges(torrent_data['pieces_indices']),
         }
         response = requests.post(TRACKER_URL + '/peer-update-download', json=payload)
         print(f'Peer {self.peer_ip}:{self.port} ' + response.text)
+        self.start_heartbeat(TRACKER_URL)
+
+    def start_heartbeat(self, tracker_url):
+        self.trackers.add(tracker_url)
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.send_heartbeats, daemon=True)
+            self.heartbeat.start()
+
+    def send_heartbeats(self):
+        while not self.heartbeat_stop.wait(self.heartbeat_interval):
+            for tracker_url in list(self.trackers):
+                try:
+                    response = requests.post(tracker_url + '/heartbeat', json={"peer_ip": self.peer_ip, "peer_port": self.port})
+                    if response.status_code != 404:
+                        continue
+                    # The tracker expired us, announce everything we hold again.
+                    print(f"\033[33mTracker {tracker_url} had expired peer {self.peer_ip}:{self.port}, announcing again\033[0m")
+                    for name in list(self.files.torrents):
+                        payload = {
+                            "peer_ip": self.peer_ip,
+                            "peer_port": self.port,
+                            "file_name": name,
+                            "piece_ranges": self.encode_ranges(self.files.torrent_pieces(name)),
+                        }
+                        requests.post(tracker_url + '/peer-update-download', json=payload)
+                except requests.RequestException as e:
+                    print(f"Failed to send heartbeat to {tracker_url}: {e}")
 
     def calculate_piece_indices_for_file(self, torrent_data, filename):
         piece_length = torrent_data['info']['piece length']
@@ -209,255 +1174,714 @@ class Peer(threading.Thread):
             end_index = end_byte // piece_length
         return list(range(start_index, end_index + 1))
 
+    def encode_ranges(self, indices):
+        ranges = []
+        for index in sorted(set(indices)):
+            if ranges and ranges[-1][1] == index - 1:
+                ranges[-1][1] = index
+            else:
+                ranges.append([index, index])
+        return ','.join(f"{start}-{end}" if end > start else str(start) for start, end in ranges)
+
+    def decode_peer_bitfields(self, peer_data, piece_indices):
+        peer_set = {str(index): [] for index in piece_indices}
+        for peer_ip, peer_port, encoded in peer_data['peers']:
+            value = [peer_ip, peer_port]
+            bitfield = base64.b64decode(encoded)
+            for position, byte in enumerate(bitfield):
+                for bit in BIT_POSITIONS[byte]:
+                    holders = peer_set.get(str(position * 8 + bit))
+                    if holders is not None:
+                        holders.append(value)
+        return peer_set
+
     def get_peers_for_pieces(self, tracker_url, filename, piece_indices):
-        piece_indices_str = ','.join(map(str, piece_indices))
-        url = f"{tracker_url}/get-peer?filename={filename}&piece_indices={piece_indices_str}"
+        params = {'filename': filename, 'piece_ranges': self.encode_ranges(piece_indices), 'format': 'compact'}
         try:
-            response = requests.get(url)
+            response = requests.get(f"{tracker_url}/get-peer", params=params, headers={'Accept-Encoding': 'gzip'})
             response.raise_for_status()
-            peer_data = response.json()
-            print(f"\033[34mReceived peer-set: \033[0m{peer_data}\033[0m")
+            compact = response.json()
+            peer_data = self.decode_peer_bitfields(compact, piece_indices)
+            print(f"\033[34mReceived peer-set: \033[0m{len(peer_data)} pieces from {len(compact['peers'])} peers\033[0m")
             return peer_data
         except requests.RequestException as e:
             print(f"Failed to get peer data: {e}")
             return {}
     
     def handle_client(self, client_socket):
+        if client_socket.recv(1, socket.MSG_PEEK) == bytes([PeerProtocol.MAGIC]):
+            return self.handle_binary_client(client_socket)
         with client_socket:
             while True:
                 data = client_socket.recv(1024).decode()
-                response = 'Response OK'
                 if not data:
                     break
-                parts = data.split()
-                file, cmd = data.rsplit(' ', 1)
-                if(cmd == 'download'):
-                    first_part = file.split('/')[0]
-                    torrent_data = self.get_torrent(first_part)
-                    requested_pieces = self.calculate_piece_indices_for_file(torrent_data, file)
-                    peer_set = self.get_peers_for_pieces(torrent_data['announce'], first_part, requested_pieces)
-                    info = {first_part: {}}
-                    is_success = [True]
-                    threads = []
-                    for piece_index, peer_ips in peer_set.items():
-                        thread = threading.Thread(target= self.request_piece_from_peer, args=(piece_index, peer_ips, first_part, info, is_success) )
-                        thread.start()
-                        threads.append(thread)
-                    for thread in threads:
-                        thread.join()
-                    if is_success[0]:
-                        temp = dict(sorted(info[first_part].items()))
-                        temp_hash = ''
-                        for index in temp:
-                            temp_hash += self.handle_file.calculate_sha1(temp[index])
-                        print(f"\033[34mDownloaded pieces hash: \033[0m{temp_hash}")
-                        if temp_hash == torrent_data['info']['pieces']:
-                            print("\033[34mDownloaded pieces match the hash in the torrent file.\033[0m")
-                            self.files.append(info)
-                            data_update = {
-                                "file_name": first_part,
-                                "pieces_indices": requested_pieces
-                            }
-                            self.update_tracker_download(data_update)
-                            self.reconstruct_file(file, torrent_data)
-                            client_socket.sendall(response.encode())
-                            print(f"\033[34mPeer {self.peer_ip}:{self.port} has downloaded: {file}\033[0m")
-                        else:
-                            print("\033[31mDownloaded pieces do not match the hash in the torrent file.\033[0m")
-
-                            response = 'Response Failed'
-                            client_socket.sendall(response.encode())
-                    else:
-                        response = 'Response Failed'
-                        print(f"\033[31mFailed to download pieces, there seems to be an issue with the peer.\033[0m")
-                        client_socket.sendall(response.encode())
-                elif(cmd == 'upload'):
-                    self.handle_file.path = file
-                    res = self.handle_file.divide_file_into_pieces()
-                    self.files.append({res['name']: {str(i): value for i, value in enumerate(res['pieces'])}})
-                    for each in self.files:
-                        for key,value in each.items():
-                            for k,v in value.items():
-                                print(f"\033[34mPiece {k} of file {key} has length: {len(v)}\033[0m")
-                    torrent_data = self.handle_file.create_torrent_file(res)
-                    self.update_tracker_upload(torrent_data)
-                    json_str = json.dumps(torrent_data)
-                    self.update_torrent_server(f"{json_str} add")
-                    client_socket.sendall(response.encode())
-                    print(f"\033[34mPeer {self.peer_ip}:{self.port} has uploaded: {file}\033[0m")
-                elif(cmd == 'block'):
-                    index, offset = parts[0].split('-')
-                    parts = file.split(' ', 1)  
-                    filename = parts[1]
-                    response = bytearray()
-                    for each in self.files:
-                        if filename in each:
-                            if index in each[filename]:
-                                piece = each[filename].get(index)
-                                piece_length = len(piece)
-                                offset = int(offset)
-                                if(offset < piece_length):
-                                    end = min(offset + self.handle_file.block_size, piece_length)
-                                    response = piece[offset:end]
-                                break
-                            else:
-                                raise ValueError(f"Piece {index} not found for file {filename}")
+                response = self.handle_command(data)
+                if response:
                     client_socket.sendall(response)
-                elif(cmd == 'length'):
-                    filename, index = file.rsplit(' ', 1)
-                    piece_length = 0
-                    for each in self.files:
-                        if filename in each:
-                            piece = each[filename].get(index)
-                            piece_length = len(piece)
-                            break
-                    client_socket.sendall(str(piece_length).encode())
-                elif(cmd == 'construct'):
-                    self.reconstruct_file(file)
-                    client_socket.sendall('Response OK'.encode())
+
+    def handle_command(self, data):
+        parts = data.split()
+        file, cmd = data.rsplit(' ', 1)
+        if(cmd == 'download'):
+            response = 'Response OK' if self.download(file) else 'Response Failed'
+            return response.encode()
+        elif(cmd == 'upload'):
+            self.upload(file)
+            return 'Response OK'.encode()
+        elif(cmd == 'block'):
+            index, offset = parts[0].split('-')
+            parts = file.split(' ', 1)  
+            filename = parts[1]
+            piece_length = self.files.get(filename, int(index))
+            if piece_length is None:
+                raise ValueError(f"Piece {index} not found for file {filename}")
+            offset = int(offset)
+            if(offset < piece_length):
+                return self.store.read(filename, int(index), offset, self.handle_file.block_size)
+        elif(cmd == 'length'):
+            filename, index = file.rsplit(' ', 1)
+            piece_length = self.files.get(filename, int(index)) or 0
+            return str(piece_length).encode()
+        elif(cmd == 'construct'):
+            # Verified pieces are written straight into the output files.
+            return 'Response OK'.encode()
+
+    def download(self, file):
+        first_part = file.split('/')[0]
+        try:
+            torrent_data = self.get_torrent(first_part)
+        except FileNotFoundError as e:
+            print(f"\033[31m{e}\033[0m")
+            return False
+        requested_pieces = self.calculate_piece_indices_for_file(torrent_data, file)
+        if not self.add_download_to_store(torrent_data, file):
+            return False
+        info = {first_part: {}}
+        missing = self.resume_download(torrent_data, requested_pieces, info)
+        peer_set = self.get_peers_for_pieces(torrent_data['announce'], first_part, missing) if missing else {}
+        is_success = self.scheduler.run(first_part, peer_set, info, torrent_data['info']['pieces'], lambda indices: self.get_peers_for_pieces(torrent_data['announce'], first_part, indices), self.block_roots(torrent_data))
+        return self.finish_download(file, torrent_data, requested_pieces, info, is_success)
+
+    def finish_download(self, file, torrent_data, requested_pieces, info, is_success):
+        first_part = file.split('/')[0]
+        if not is_success:
+            print(f"\033[31mFailed to download pieces, there seems to be an issue with the peer.\033[0m")
+            return False
+        temp = info[first_part]
+        missing = [index for index in requested_pieces if str(index) not in temp]
+        if missing:
+            print(f"\033[31mPieces {missing} were not verified against the hashes in the torrent file.\033[0m")
+            return False
+        print(f"\033[34mAll {len(temp)} downloaded pieces match their hashes in the torrent file.\033[0m")
+        self.files.add(first_part, {int(index): self.store.piece_length(first_part, int(index)) for index in temp})
+        data_update = {
+            "file_name": first_part,
+            "pieces_indices": requested_pieces
+        }
+        self.update_tracker_download(data_update)
+        print(f"\033[34mFile successfully reconstructed and saved to \033[0m{os.path.join(self.OUTPUT_PATH, file)}\033[0m")
+        print(f"\033[34mPeer {self.peer_ip}:{self.port} has downloaded: {file}\033[0m")
+        return True
+
+    def upload(self, file):
+        self.handle_file.path = file
+        res = self.handle_file.divide_file_into_pieces(stream=True)
+        self.store.add_torrent(res['name'], self.handle_file.piece_size, [(path, size) for path, _, size in self.handle_file.list_files()])
+        self.files.add(res['name'], {i: self.handle_file.piece_length(value) for i, value in enumerate(res['pieces'])})
+        self.seeded.add(res['name'])
+        self.bitfields.pop(res['name'], None)
+        for k, v in sorted(self.files.torrent_pieces(res['name']).items()):
+            print(f"\033[34mPiece {k} of file {res['name']} has length: {v}\033[0m")
+        torrent_data = self.handle_file.create_torrent_file(res)
+        with self.block_trees_lock:
+            for key in [key for key in self.block_trees if key[0] == res['name']]:
+                del self.block_trees[key]
+        self.update_tracker_upload(torrent_data)
+        json_str = json.dumps(torrent_data)
+        self.update_torrent_server(f"{json_str} add")
+        print(f"\033[34mPeer {self.peer_ip}:{self.port} has uploaded: {file}\033[0m")
+
+    def handle_binary_client(self, client_socket):
+        protocol = PeerProtocol(client_socket)
+        with client_socket:
+            while True:
+                try:
+                    frame = protocol.recv()
+                except ConnectionError:
+                    break
+                if frame['type'] == PeerProtocol.HELLO:
+                    protocol.version = min(PeerProtocol.VERSION, frame['version'])
+                    protocol.send(PeerProtocol.HELLO)
+                    continue
+                try:
+                    filename = frame['payload'].decode()
+                except UnicodeDecodeError:
+                    protocol.send(PeerProtocol.ERROR, frame['index'], frame['offset'], payload=b"File name is not valid UTF-8")
+                    continue
+                piece_length = self.files.get(filename, frame['index'])
+                if frame['type'] == PeerProtocol.LENGTH:
+                    protocol.send(PeerProtocol.LENGTH, frame['index'], length=piece_length or 0)
+                elif frame['type'] in (PeerProtocol.BLOCK, PeerProtocol.BLOCK_PROOF):
+                    if piece_length is None or frame['offset'] >= piece_length:
+                        protocol.send(PeerProtocol.ERROR, frame['index'], frame['offset'], payload=f"Piece {frame['index']} not found for file {filename}".encode())
+                        continue
+                    size = min(frame['length'], piece_length - frame['offset'])
+                    proof = self.block_proof(filename, frame['index'], frame['offset']) if frame['type'] == PeerProtocol.BLOCK_PROOF else b''
+                    client_socket.sendall(protocol.pack(PeerProtocol.BLOCK, frame['index'], frame['offset'], size, size + len(proof)))
+                    self.store.send(client_socket, filename, frame['index'], frame['offset'], size)
+                    if proof:
+                        client_socket.sendall(proof)
+                else:
+                    protocol.send(PeerProtocol.ERROR, frame['index'], payload=f"Unknown message type {frame['type']}".encode())
+
+    def connect_to_peer(self, peer_ip, peer_port):
+        sock = socket.create_connection((peer_ip, peer_port), timeout=self.request_timeout)
+        protocol = PeerProtocol(sock)
+        try:
+            self.peer_versions[(peer_ip, peer_port)] = protocol.negotiate()
+        except (ConnectionError, ValueError, struct.error):
+            # The peer hung up on HELLO or answered with something else: it only speaks text.
+            sock.close()
+            self.peer_versions[(peer_ip, peer_port)] = 0
+            return None, None
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock, protocol
 
     def stop(self):
         self.running = False
+        self.heartbeat_stop.set()
+        self.connections.close_all()
         temp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         temp_socket.connect((self.peer_ip, self.port))
         temp_socket.close()
 
+    def request_torrent_server(self, data):
+        # Length-framed exchange with s.py, so torrents of any size arrive whole.
+        payload = data.encode()
+        with socket.create_connection((self.SERVER_IP, self.SERVER_PORT)) as peer_socket:
+            peer_socket.sendall(struct.pack('!BI', self.TORRENT_SERVER_MAGIC, len(payload)) + payload)
+            length, = struct.unpack('!I', self.recv_torrent_server(peer_socket, 4))
+            return self.recv_torrent_server(peer_socket, length).decode()
+
+    def recv_torrent_server(self, peer_socket, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = peer_socket.recv(min(size - len(data), 1 << 20))
+            if not chunk:
+                raise ConnectionError("Torrent server closed the connection")
+            data.extend(chunk)
+        return bytes(data)
+
     def get_torrent(self, file):
-        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        peer_socket.connect((self.SERVER_IP, self.SERVER_PORT))
-        peer_socket.sendall(f"{file} get".encode())
-        response = peer_socket.recv(1024).decode() 
-        peer_socket.close()
-        
+        cached = self.torrent_cache.get(file) or self.load_cached_torrent(file)
+        if cached:
+            if time.monotonic() - cached['checked'] < self.metadata_ttl:
+                return cached['torrent']
+            response = self.request_torrent_server(f"{file} {cached['digest']} validate")
+            if response == 'Valid':
+                cached['checked'] = time.monotonic()
+                print(f"\033[34mPeer {self.peer_ip}:{self.port} is using its cached torrent file for {file}\033[0m")
+                return cached['torrent']
+        else:
+            response = self.request_torrent_server(f"{file} get")
+        if response == 'File not found':
+            # A stale cache entry would otherwise be revalidated, and fail, on every call.
+            self.torrent_cache.pop(file, None)
+            with suppress(FileNotFoundError):
+                os.remove(self.torrent_cache_path(file))
+            raise FileNotFoundError(f"The torrent server has no torrent named {file}")
         torrent = json.loads(response)
+        self.cache_torrent(file, response, torrent)
         print(f"\033[34mPeer {self.peer_ip}:{self.port} has received torrent file:\033[0m")
         pprint.pprint(torrent)
         return torrent
 
-    def request_block_from_peer(self, piece_index, block_offset, peer_ips, file, index, blocks, info):
-        temp = peer_ips
-        
-        while True:
-            value = random.choice(temp)
-            try: 
-                peer_ip, peer_port = value
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((peer_ip, peer_port))
-                sock.sendall(f"{piece_index}-{block_offset} {file} block".encode())
-                response = sock.recv(self.handle_file.block_size)
-                sock.close()
-                blocks[index] = response
-                break
-            except: 
-                with suppress(ValueError):
-                    temp.remove(value)
-                if len(temp) == 0:
-                    info['is_success'] = False
-                    break
+    def torrent_cache_path(self, file):
+        return os.path.join(self.OUTPUT_PATH, '.torrents', file + '.json')
+
+    def load_cached_torrent(self, file):
+        try:
+            with open(self.torrent_cache_path(file), 'rb') as f:
+                response = f.read()
+            torrent = json.loads(response)
+        except (OSError, ValueError):
+            return None
+        # Loaded from disk, so it is validated against the server before use.
+        cached = {'digest': hashlib.sha1(response).hexdigest(), 'torrent': torrent, 'checked': float('-inf')}
+        self.torrent_cache[file] = cached
+        return cached
+
+    def cache_torrent(self, file, response, torrent):
+        response = response.encode()
+        self.torrent_cache[file] = {'digest': hashlib.sha1(response).hexdigest(), 'torrent': torrent, 'checked': time.monotonic()}
+        path = self.torrent_cache_path(file)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(response)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"\033[31mCould not cache the torrent file for {file}: {e}\033[0m")
+
+    def request_block(self, peer_ip, peer_port, file, piece_index, block_offset, block_length, futures=None, root=None):
+        start = time.perf_counter()
+        try:
+            connection = self.connections.get(peer_ip, peer_port)
+            if connection:
+                msg_type = PeerProtocol.BLOCK_PROOF if root and connection.protocol.version >= 2 else PeerProtocol.BLOCK
+                future = connection.request(msg_type, int(piece_index), block_offset, block_length, file.encode())
+                if futures is not None:
+                    futures.append(future)
+                try:
+                    frame = future.result(timeout=self.request_timeout)
+                except TimeoutError:
+                    # A peer that stopped answering would keep every pipeline slot forever;
+                    # closing fails its other requests and the next one reconnects.
+                    connection.close()
+                    raise
+                response = frame['payload']
+                if msg_type == PeerProtocol.BLOCK_PROOF:
+                    response, proof = response[:frame['length']], response[frame['length']:]
+                    self.check_block(peer_ip, peer_port, file, piece_index, block_offset, response, proof, root)
+            else:
+                with socket.create_connection((peer_ip, peer_port), timeout=self.request_timeout) as sock:
+                    sock.sendall(f"{piece_index}-{block_offset} {file} block".encode())
+                    response = bytearray()
+                    while len(response) < block_length:
+                        chunk = sock.recv(block_length - len(response))
+                        if not chunk:
+                            break
+                        response.extend(chunk)
+            if len(response) != block_length:
+                raise ValueError(f"Short block {piece_index}-{block_offset}: {len(response)} of {block_length} bytes")
+        except CancelledError:
+            raise
+        except Exception:
+            self.peer_stats.fail((peer_ip, peer_port))
+            raise
+        self.peer_stats.record((peer_ip, peer_port), time.perf_counter() - start, block_length)
+        return response
+
+    def block_roots(self, torrent_data):
+        # Roots only line up with our requests when both sides use the same block size.
+        if torrent_data['info'].get('block length') != self.handle_file.block_size:
+            return ''
+        return torrent_data['info'].get('block roots', '')
+
+    def block_proof(self, file, piece_index, block_offset):
+        key = (file, piece_index)
+        with self.block_trees_lock:
+            tree = self.block_trees.get(key)
+            if tree is not None:
+                self.block_trees.move_to_end(key)
+        if tree is None:
+            piece = self.store.read(file, piece_index, 0, self.store.piece_length(file, piece_index))
+            tree = BlockTree(BlockTree.leaves(piece, self.handle_file.block_size))
+            with self.block_trees_lock:
+                self.block_trees[key] = tree
+                while len(self.block_trees) > self.max_block_trees:
+                    self.block_trees.popitem(last=False)
+        return b''.join(tree.proof(block_offset // self.handle_file.block_size))
 
-    def request_piece_from_peer(self, piece_index, peer_ips, file, piece_info, is_success):
-        piece_size = 0
-        temp = peer_ips
+    def check_block(self, peer_ip, peer_port, file, piece_index, block_offset, block, proof, root):
+        block_size = self.handle_file.block_size
+        count = math.ceil(self.store.piece_length(file, int(piece_index)) / block_size)
+        proof = [bytes(proof[i:i + 20]) for i in range(0, len(proof), 20)]
+        if not BlockTree.verify(hashlib.sha1(block).digest(), block_offset // block_size, count, proof, bytes.fromhex(root)):
+            self.penalise_peer((peer_ip, peer_port))
+            raise ValueError(f"Block {piece_index}-{block_offset} from {peer_ip}:{peer_port} failed its Merkle proof")
+
+    def store_piece(self, file, piece_index, piece, expected=None):
+        digest = self.handle_file.calculate_sha1(piece)
+        if expected and digest != expected:
+            return None
+        self.store.write(file, int(piece_index), piece)
+        if file in self.bitfields:
+            self.bitfields[file].set(int(piece_index))
+        return digest
+
+    def penalise_peer(self, value):
+        key = tuple(value)
+        self.peer_penalties[key] = self.peer_penalties.get(key, 0) + 1
+        if self.peer_penalties[key] == self.max_penalties:
+            print(f"\033[31mPeer {key[0]}:{key[1]} sent {self.max_penalties} corrupt pieces and is no longer used\033[0m")
+
+    def is_banned(self, value):
+        return self.peer_penalties.get(tuple(value), 0) >= self.max_penalties
+
+    def add_download_to_store(self, torrent_data, file):
+        name = torrent_data['info']['name']
+        if name in self.seeded:
+            # The store points at the uploaded source files; verified pieces must not be written over them.
+            print(f"\033[31mPeer {self.peer_ip}:{self.port} already seeds {name} from its source files, not downloading it\033[0m")
+            return False
+        key = hashlib.sha1(torrent_data['info']['pieces'].encode()).digest()
+        bitfield = self.bitfields.get(name)
+        fresh = bitfield is None or bitfield.key != key
+        if fresh:
+            self.requested_files[name] = self.load_requested_files(name, key)
+        requested = self.requested_files[name]
+        saved = set(requested)
+        if 'length' in torrent_data['info']:
+            files = [(os.path.join(self.OUTPUT_PATH, name), torrent_data['info']['length'])]
+            requested.add(files[0][0])
+        else:
+            entries = sorted(torrent_data['info']['files'], key=lambda entry: entry['mapping']['start_offset'])
+            requested.update(os.path.join(self.OUTPUT_PATH, *entry['path']) for entry in entries if file in (name, '/'.join(entry['path'])))
+            files = []
+            for entry in entries:
+                path = os.path.join(self.OUTPUT_PATH, *entry['path'])
+                # Files nobody asked for only receive the bytes of shared boundary pieces, so
+                # they live in a spool under .pieces until they are requested themselves.
+                spool_path = os.path.join(self.OUTPUT_PATH, '.pieces', 'spool', *entry['path'])
+                if path not in requested:
+                    path = spool_path
+                elif os.path.exists(spool_path) and not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(spool_path, path)
+                files.append((path, entry['length']))
+        if requested != saved:
+            self.save_requested_files(name, key)
+        self.store.add_torrent(name, torrent_data['info']['piece length'], files)
+        if fresh:
+            bitfield_path = os.path.join(self.OUTPUT_PATH, '.pieces', name + '.bitfield')
+            self.bitfields[name] = Bitfield(bitfield_path, self.store.piece_count(name), torrent_data['info']['pieces'])
+        return True
+
+    def requested_files_path(self, name):
+        return os.path.join(self.OUTPUT_PATH, '.pieces', name + '.requested')
+
+    def load_requested_files(self, name, key):
+        # Kept next to the bitfield, so files downloaded before a restart are not moved back to the spool.
+        try:
+            with open(self.requested_files_path(name), 'rb') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if saved.get('key') != key.hex():
+            return set()
+        return {os.path.join(self.OUTPUT_PATH, *path) for path in saved['files']}
+
+    def save_requested_files(self, name, key):
+        path = self.requested_files_path(name)
+        files = sorted(os.path.relpath(file, self.OUTPUT_PATH).split(os.sep) for file in self.requested_files[name])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'key': key.hex(), 'files': files}, f)
+        os.replace(path + '.tmp', path)
+
+    def resume_download(self, torrent_data, requested_pieces, info):
+        name = torrent_data['info']['name']
+        bitfield = self.bitfields[name]
+        hashes = torrent_data['info']['pieces']
+        missing = []
+        for index in requested_pieces:
+            # A piece only counts as done while every file it was written to is still there.
+            if bitfield.has(index) and all(os.path.exists(path) for path, _, _ in self.store.spans(name, index, 0, self.store.piece_length(name, index))):
+                info[name][str(index)] = hashes[index * 40:(index + 1) * 40]
+            else:
+                missing.append(index)
+        if len(missing) < len(requested_pieces):
+            print(f"\033[34mResuming {name}: {len(requested_pieces) - len(missing)} of {len(requested_pieces)} pieces are already on disk\033[0m")
+        self.store.allocate(name, missing, self.requested_files[name])
+        return missing
+
+    def update_torrent_server(self, data):
+        return self.request_torrent_server(data)
+
+class AsyncPeerConnection:
+    def __init__(self, reader, writer, protocol, depth):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        self.pending = deque()
+        self.slots = asyncio.Semaphore(depth)
+        self.closed = False
+        self.task = asyncio.ensure_future(self.read_responses())
+
+    @staticmethod
+    async def read_frame(reader, prefix=b''):
+        header = prefix + await reader.readexactly(PeerProtocol.header.size - len(prefix))
+        frame = PeerProtocol.unpack(header)
+        payload_length = frame.pop('payload_length')
+        frame['payload'] = await reader.readexactly(payload_length) if payload_length else b''
+        return frame
+
+    @classmethod
+    async def open(cls, peer_ip, peer_port, depth, timeout=None):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(peer_ip, peer_port), timeout)
+        protocol = PeerProtocol(None)
+        try:
+            writer.write(protocol.pack(PeerProtocol.HELLO))
+            await asyncio.wait_for(writer.drain(), timeout)
+            frame = await asyncio.wait_for(cls.read_frame(reader), timeout)
+            if frame['type'] != PeerProtocol.HELLO:
+                raise ValueError(f"Expected HELLO, got message type {frame['type']}")
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, struct.error):
+            # The peer hung up on HELLO or answered with something else: it only speaks text.
+            writer.close()
+            return None
+        except (OSError, asyncio.TimeoutError):
+            writer.close()
+            raise
+        protocol.version = min(PeerProtocol.VERSION, frame['version'])
+        return cls(reader, writer, protocol, depth)
+
+    async def request(self, msg_type, index=0, offset=0, length=0, payload=b''):
+        await self.slots.acquire()
+        if self.closed:
+            self.slots.release()
+            raise ConnectionError("Connection is closed")
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(self.protocol.pack(msg_type, index, offset, length, len(payload)) + payload)
+        await self.writer.drain()
+        return await future
+
+    async def read_responses(self):
+        try:
+            while True:
+                frame = await self.read_frame(self.reader)
+                future = self.pending.popleft()
+                self.slots.release()
+                if future.done():
+                    continue
+                if frame['type'] == PeerProtocol.ERROR:
+                    future.set_exception(ValueError(frame['payload'].decode()))
+                else:
+                    future.set_result(frame)
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError, struct.error):
+            self.close()
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+        while self.pending:
+            future = self.pending.popleft()
+            self.slots.release()
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed with requests in flight"))
+
+
+class AsyncPeer(Peer):
+    def __init__(self, port= 5000):
+        super().__init__(port)
+        self.loop = None
+        self.server = None
+        self.max_transfers = 1024
+        self.async_connections = {}
+        self.connect_locks = {}
+        self.connect_failures = {}
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def prepare(self):
+        self.loop = asyncio.get_running_loop()
+        self.transfers = asyncio.Semaphore(self.max_transfers)
+
+    async def serve(self):
+        await self.prepare()
+        self.server = await asyncio.start_server(self.handle_connection, self.peer_ip, self.port, backlog=1024)
+        print(f"\033[33mPeer {self.peer_ip}:{self.port} listening on port {self.port}\033[0m")
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for connection in list(self.async_connections.values()):
+                connection.close()
+            print(f"\033[33mPeer {self.peer_ip} listening on port {self.port}\033[0m")
+
+    def stop(self):
+        self.running = False
+        self.heartbeat_stop.set()
+        self.connections.close_all()
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def handle_connection(self, reader, writer):
+        print(f"\033[96mPeer {self.peer_ip}:{self.port} connected to {writer.get_extra_info('peername')}\033[0m")
+        try:
+            first = await reader.read(1)
+            if first == bytes([PeerProtocol.MAGIC]):
+                await self.serve_frames(reader, writer, first)
+            elif first:
+                await self.serve_commands(reader, writer, first)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_frames(self, reader, writer, first):
+        protocol = PeerProtocol(None)
+        frame = await AsyncPeerConnection.read_frame(reader, first)
         while True:
-            value = random.choice(temp)
-            try: 
-                peer_ip, peer_port = value
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((peer_ip, peer_port))
-                sock.sendall(f"{file} {piece_index} length".encode())
-                piece_size = sock.recv(1024)
-                sock.close()
-                if(piece_size):
-                    break
-                else: 
-                    with suppress(ValueError):
-                        temp.remove(value)
-                    if len(temp) == 0:
-                        return {'is_success': False}
-            except: 
+            if frame['type'] == PeerProtocol.HELLO:
+                protocol.version = min(PeerProtocol.VERSION, frame['version'])
+                writer.write(protocol.pack(PeerProtocol.HELLO))
+            else:
+                try:
+                    filename = frame['payload'].decode()
+                except UnicodeDecodeError:
+                    filename = None
+                piece_length = self.files.get(filename, frame['index']) if filename is not None else None
+                if filename is None:
+                    error = b"File name is not valid UTF-8"
+                    writer.write(protocol.pack(PeerProtocol.ERROR, frame['index'], frame['offset'], payload_length=len(error)) + error)
+                elif frame['type'] == PeerProtocol.LENGTH:
+                    writer.write(protocol.pack(PeerProtocol.LENGTH, frame['index'], length=piece_length or 0))
+                elif frame['type'] in (PeerProtocol.BLOCK, PeerProtocol.BLOCK_PROOF) and piece_length is not None and frame['offset'] < piece_length:
+                    size = min(frame['length'], piece_length - frame['offset'])
+                    data = await self.loop.run_in_executor(None, self.store.read, filename, frame['index'], frame['offset'], size)
+                    if frame['type'] == PeerProtocol.BLOCK_PROOF:
+                        data += await self.loop.run_in_executor(None, self.block_proof, filename, frame['index'], frame['offset'])
+                    writer.write(protocol.pack(PeerProtocol.BLOCK, frame['index'], frame['offset'], size, len(data)) + data)
+                else:
+                    error = f"Piece {frame['index']} not found for file {filename}".encode()
+                    writer.write(protocol.pack(PeerProtocol.ERROR, frame['index'], frame['offset'], payload_length=len(error)) + error)
+            await writer.drain()
+            frame = await AsyncPeerConnection.read_frame(reader)
+
+    async def serve_commands(self, reader, writer, first):
+        data = first + await reader.read(1023)
+        while data:
+            text = data.decode()
+            file, cmd = text.rsplit(' ', 1)
+            if cmd == 'download':
+                response = ('Response OK' if await self.download_async(file) else 'Response Failed').encode()
+            else:
+                response = await self.loop.run_in_executor(None, self.handle_command, text)
+            if response:
+                writer.write(response)
+                await writer.drain()
+            data = await reader.read(1024)
+
+    async def get_async_connection(self, peer_ip, peer_port):
+        key = (peer_ip, peer_port)
+        async with self.connect_locks.setdefault(key, asyncio.Lock()):
+            connection = self.async_connections.get(key)
+            if connection and not connection.closed:
+                return connection
+            if self.peer_versions.get(key) == 0:
+                return None
+            # Blocks queued behind a peer that just failed to connect fail fast instead of each waiting out the timeout.
+            if time.monotonic() - self.connect_failures.get(key, float('-inf')) < self.request_timeout:
+                raise ConnectionError(f"Peer {peer_ip}:{peer_port} failed to connect recently")
+            try:
+                connection = await AsyncPeerConnection.open(peer_ip, peer_port, self.pipeline_depth, self.request_timeout)
+            except (OSError, asyncio.TimeoutError):
+                self.connect_failures[key] = time.monotonic()
+                raise
+            if connection is None:
+                self.peer_versions[key] = 0
+                return None
+            self.peer_versions[key] = connection.protocol.version
+            self.async_connections[key] = connection
+            return connection
+
+    async def fetch_block(self, file, piece_index, block_offset, block_length, peer_ips, root=None):
+        while peer_ips:
+            value = self.peer_stats.order(peer_ips)[0]
+            peer_ip, peer_port = value
+            start = time.perf_counter()
+            try:
+                async with self.transfers:
+                    connection = await self.get_async_connection(peer_ip, peer_port)
+                    if connection:
+                        msg_type = PeerProtocol.BLOCK_PROOF if root and connection.protocol.version >= 2 else PeerProtocol.BLOCK
+                        try:
+                            frame = await asyncio.wait_for(connection.request(msg_type, int(piece_index), block_offset, block_length, file.encode()), self.request_timeout)
+                        except asyncio.TimeoutError:
+                            # Same as the threaded client: a silent peer would keep its slots, so drop
+                            # the connection and let the next fetch reconnect.
+                            connection.close()
+                            raise
+                        response = frame['payload']
+                        if msg_type == PeerProtocol.BLOCK_PROOF:
+                            response, proof = response[:frame['length']], response[frame['length']:]
+                            self.check_block(peer_ip, peer_port, file, piece_index, block_offset, response, proof, root)
+                    else:
+                        response = await asyncio.wait_for(self.fetch_text_block(peer_ip, peer_port, file, piece_index, block_offset, block_length), self.request_timeout)
+                if len(response) != block_length:
+                    raise ValueError(f"Short block {piece_index}-{block_offset}: {len(response)} of {block_length} bytes")
+                self.peer_stats.record(value, time.perf_counter() - start, block_length)
+                return value, response
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError, struct.error):
+                self.peer_stats.fail(value)
                 with suppress(ValueError):
-                    temp.remove(value)
-                if len(temp) == 0:
-                    return {'is_success': False}
-        piece = bytearray()
-        blocks = {}
-        block_offset = 0
-        info = {'is_success': True}
-        num = math.ceil(int(piece_size.decode()) / self.handle_file.block_size)
-        pool = []
-        for index in range(num):
-            block_offset = index * self.handle_file.block_size
-            thread = threading.Thread(target=self.request_block_from_peer, args=(piece_index, block_offset, peer_ips, file, index, blocks, info))
-            thread.start()
-            pool.append(thread)
-
-        for thread in pool:
-            thread.join()
-
-        blocks = dict(sorted(blocks.items()))
-        for index in blocks:
-            piece.extend(blocks[index])
-        info['piece'] = piece
-        is_success[0] = info['is_success']
-        piece_info[file][piece_index] = piece
-
-    def reconstruct_file(self, target_filename, torrent_data):
-        root = target_filename.split('/')[0]
-        
-        for file_dict in self.files:
-            if root in file_dict:
-                pieces = file_dict[root]
-                sorted_piece_keys = sorted(pieces.keys(), key=int)
-                complete_file_data = bytearray()
-                for key in sorted_piece_keys:
-                    complete_file_data.extend(pieces[key])
-                if not os.path.exists(self.OUTPUT_PATH):
-                    os.makedirs(self.OUTPUT_PATH)
-                if('length' in torrent_data['info']):
-                    output_path = os.path.join(self.OUTPUT_PATH, root)
-                    with open(output_path, 'wb') as file:
-                        file.write(complete_file_data)
-                    print(f"\033[34mFile successfully reconstructed and saved to \033[0m{output_path}\033[0m")
-                else: 
-                    name = torrent_data['info']['name']
-                    files = torrent_data['info']['files']
-                    for file_info in files:
-                        file_path = os.path.join(*file_info['path'])
-                        if target_filename == file_path:
-                            dirs = file_info['path'][:-1]
-                            output_dir = os.path.join(*dirs)
-                            os.makedirs(output_dir, exist_ok=True)
-                            output_path = os.path.join(self.OUTPUT_PATH, file_info['path'][-1])
-                            with open(output_path, 'wb') as file:
-                                start = file_info['mapping']['start_offset']
-                                end = file_info['mapping']['end_offset']
-                                file.write(complete_file_data[start:end])
-                            print(f"\033[34mFile successfully reconstructed and saved to \033[0m{output_path}\033[0m")
-                            return
-                    if target_filename == name:
-                        for file_info in files:
-                            dirs = file_info['path'][:-1]
-                            output_dir = os.path.join(self.OUTPUT_PATH, *dirs)
-                            os.makedirs(output_dir, exist_ok=True)
-                            output_path = os.path.join(output_dir, file_info['path'][-1])
-                            with open(output_path, 'wb') as file:
-                                start = file_info['mapping']['start_offset']
-                                end = file_info['mapping']['end_offset']
-                                file.write(complete_file_data[start:end])
-                        print(f"\033[34mFile successfully reconstructed and saved to \033[0m{target_filename}\033[0m")
-                            
-                return
-        print(f"File {target_filename} not found in the provided data.")
+                    peer_ips.remove(value)
+        return None, None
+
+    async def fetch_text_block(self, peer_ip, peer_port, file, piece_index, block_offset, block_length):
+        reader, writer = await asyncio.open_connection(peer_ip, peer_port)
+        try:
+            writer.write(f"{piece_index}-{block_offset} {file} block".encode())
+            await writer.drain()
+            return await reader.readexactly(block_length)
+        finally:
+            writer.close()
+
+    async def fetch_piece(self, file, piece_index, peer_ips, piece_info, expected='', root=None):
+        piece_size = self.store.piece_length(file, int(piece_index))
+        block_size = self.handle_file.block_size
+        pinned = None
+        suspect = None
+        for _ in range(self.scheduler.max_piece_retries + 1):
+            holders = [pinned] if pinned else [value for value in peer_ips if not self.is_banned(value)]
+            results = await asyncio.gather(*(self.fetch_block(file, piece_index, offset, min(block_size, piece_size - offset), holders, root) for offset in range(0, piece_size, block_size)))
+            if any(block is None for _, block in results):
+                return False
+            piece = b''.join(block for _, block in results)
+            digest = await self.loop.run_in_executor(None, self.store_piece, file, piece_index, piece, expected)
+            if digest:
+                for (value, block), (_, verified) in zip(suspect or [], results):
+                    if block != verified:
+                        self.penalise_peer(value)
+                piece_info[file][piece_index] = digest
+                return True
+            print(f"\033[31mPiece {piece_index} of {file} failed its hash check, re-fetching it\033[0m")
+            sources = {tuple(value) for value, _ in results}
+            pinned = None
+            if len(sources) == 1:
+                self.penalise_peer(next(iter(sources)))
+                others = [value for value in peer_ips if tuple(value) not in sources]
+                if others:
+                    peer_ips[:] = others
+            else:
+                suspect = suspect or results
+                candidates = [value for value in peer_ips if not self.is_banned(value)]
+                pinned = min(candidates, key=lambda value: (self.peer_penalties.get(tuple(value), 0), random.random())) if candidates else None
+        return False
+
+    async def download_async(self, file):
+        first_part = file.split('/')[0]
+        try:
+            torrent_data = await self.loop.run_in_executor(None, self.get_torrent, first_part)
+        except FileNotFoundError as e:
+            print(f"\033[31m{e}\033[0m")
+            return False
+        requested_pieces = self.calculate_piece_indices_for_file(torrent_data, file)
+        if not await self.loop.run_in_executor(None, self.add_download_to_store, torrent_data, file):
+            return False
+        info = {first_part: {}}
+        missing = await self.loop.run_in_executor(None, self.resume_download, torrent_data, requested_pieces, info)
+        peer_set = await self.loop.run_in_executor(None, self.get_peers_for_pieces, torrent_data['announce'], first_part, missing) if missing else {}
+        picker = PiecePicker(peer_set)
+        order = iter(picker.pick, None)
+        hashes = torrent_data['info']['pieces']
+        roots = self.block_roots(torrent_data)
+        results = await asyncio.gather(*(self.fetch_piece(first_part, piece_index, picker.holders[piece_index], info, hashes[int(piece_index) * 40:(int(piece_index) + 1) * 40], roots[int(piece_index) * 40:(int(piece_index) + 1) * 40]) for piece_index in order))
+        return await self.loop.run_in_executor(None, self.finish_download, file, torrent_data, requested_pieces, info, all(results))
 
-    def update_torrent_server(self, data):
-        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        peer_socket.connect((self.SERVER_IP, self.SERVER_PORT))
-        peer_socket.sendall(data.encode())
-        response = peer_socket.recv(1024).decode() 
-        peer_socket.close()
 
 def main():
-    peer = Peer()
+    peer = AsyncPeer() if '--async' in sys.argv else Peer()
     peer.start()
     while True:
         cmd = input("> ").upper()
@@ -476,12 +1900,21 @@ def main():
             response = peer_socket.recv(1024)
             peer_socket.close()
         elif cmd == "SHOW": 
-            response = requests.get(TRACKER_URL + '/show')
-            response.raise_for_status()
-            data = response.json()  
-            if 'files' in data:
-                for name in data['files']:
+            search = input(">> search (blank for all): ")
+            params = {'search': search, 'limit': 50}
+            while True:
+                response = requests.get(TRACKER_URL + '/show', params=params)
+                response.raise_for_status()
+                data = response.json()  
+                for name in data.get('files', []):
                     print(name)
+                if not data.get('next_cursor') or input(">> Enter for more, anything else to stop: "):
+                    break
+                params['cursor'] = data['next_cursor']
+        elif cmd == "PEERS":
+            for value, stats in sorted(peer.peer_stats.scores().items(), key=lambda item: item[1]['score'], reverse=True):
+                rtt = f"{stats['rtt'] * 1000:.1f}ms" if stats['rtt'] is not None else '-'
+                print(f"\033[34m{value}\033[0m score {stats['score'] / 2**20:.2f} MiB/s, rtt {rtt}, {stats['bytes']} bytes, {stats['failures']}/{stats['requests']} failed")
         elif cmd == "STOP":
             break
 
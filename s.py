@@ -1,8 +1,16 @@
 import socket
 import threading
 import json
+import struct
+import hashlib
+
+class Server(threading.Thread):
+    # Framed requests start with MAGIC and a 4 byte big-endian length, and get
+    # a length-prefixed reply. Anything else is the old single-recv protocol.
+    MAGIC = 0xB8
+    HEADER = struct.Struct('!BI')
+    LENGTH = struct.Struct('!I')
 
-class Server(threading.Thread): 
     def __init__(self, port = 6000):
         super().__init__()
         self.host_name = socket.gethostname()
@@ -12,44 +20,101 @@ class Server(threading.Thread):
         self.torrent_tracker = {}
         self.max_peers = 10
         self.running = True
-        self.torrents = []
-    def handle_client(self, server_socket):
+        self.torrents = {}
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def handle_command(self, data):
+        if isinstance(data, bytes):
+            try:
+                data = data.decode()
+            except UnicodeDecodeError:
+                return "Invalid command".encode()
+        parts = data.split()
+        if not parts:
+            return "Unknown command".encode()
+        cmd = parts.pop()
+        if cmd == 'add':
+            last_closing_brace_index = data.rfind('}')
+            json_str = data[:last_closing_brace_index + 1]
+            try:
+                name = json.loads(json_str)['info']['name']
+                if not isinstance(name, str):
+                    raise TypeError(f"Torrent name {name!r} is not a string")
+            except (ValueError, KeyError, TypeError) as e:
+                # Answered instead of raised, so the client is told why rather than seeing the connection drop.
+                print(f"Rejected torrent: {e!r}")
+                return "Invalid torrent".encode()
+            with self.lock:
+                self.torrents[name] = json_str.encode()
+                self.digests[name] = hashlib.sha1(self.torrents[name]).hexdigest()
+            print(f"Added torrent {name} ({len(json_str)} bytes, {len(self.torrents)} torrents)")
+            return "Added".encode()
+        if cmd == 'get':
+            file = ' '.join(parts)
+            torrent = self.torrents.get(file)
+            if torrent is None:
+                return "File not found".encode()
+            return torrent
+        if cmd == 'validate' and len(parts) > 1:
+            # Peers send the SHA-1 of their cached copy; only a changed torrent is sent back.
+            digest = parts.pop()
+            file = ' '.join(parts)
+            torrent = self.torrents.get(file)
+            if torrent is None:
+                return "File not found".encode()
+            if self.digests.get(file) == digest:
+                return "Valid".encode()
+            return torrent
+        return "Unknown command".encode()
+
+    def recv_exact(self, client_socket, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = client_socket.recv(min(size - len(data), 1 << 20))
+            if not chunk:
+                return None
+            data.extend(chunk)
+        return bytes(data)
+
+    def handle_client(self, client_socket):
+        with client_socket:
+            if client_socket.recv(1, socket.MSG_PEEK) == bytes([self.MAGIC]):
+                while True:
+                    header = self.recv_exact(client_socket, self.HEADER.size)
+                    if header is None:
+                        break
+                    magic, length = self.HEADER.unpack(header)
+                    data = self.recv_exact(client_socket, length) if magic == self.MAGIC else None
+                    if data is None:
+                        break
+                    response = self.handle_command(data)
+                    client_socket.sendall(self.LENGTH.pack(len(response)) + response)
+                return
+            while True:
+                data = client_socket.recv(1024).decode()
+                if not data:
+                    break
+                client_socket.sendall(self.handle_command(data))
+
+    def accept_clients(self, server_socket):
         try:
             while self.running:
                 client_socket, addr = server_socket.accept()
-                if not self.running: 
+                if not self.running:
                     break
                 print(f"Sever {self.ip}:{self.port} connected to {addr}")
-                while True:
-                    data = client_socket.recv(1024).decode()
-                    if not data:
-                        break
-                    parts = data.split()
-                    cmd = parts.pop()
-                    if cmd == 'add':
-                        last_closing_brace_index = data.rfind('}')
-                        json_str = data[:last_closing_brace_index + 1]
-                        json_obj = json.loads(json_str)
-                        self.torrents.append(json_obj)
-                        print(self.torrents)
-                        client_socket.sendall("Added".encode())
-                    if cmd == 'get':
-                        file = ' '.join(parts)
-                        for torrent in self.torrents:
-                            if torrent['info']['name'] == file:
-                                client_socket.sendall(json.dumps(torrent).encode())
-                                break
-                        else:
-                            client_socket.sendall("File not found".encode())
+                threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
         finally:
             print(f"Closing server socket on {self.ip}")
             server_socket.close()
+
     def run(self):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.bind((self.ip, self.port))
-        server_socket.listen(self.max_peers)
+        server_socket.listen(128)
         print(f"Server is listening on {self.ip}:{self.port}")
-        thread1 = threading.Thread(target=self.handle_client, args=(server_socket,))
+        thread1 = threading.Thread(target=self.accept_clients, args=(server_socket,))
         thread1.start()
         thread1.join()
     def stop(self):
@@ -70,6 +135,6 @@ def main():
             break
     server.stop()
     server.join()
-    
+
 if __name__ == "__main__":
     main()
@@ -1,10 +1,252 @@
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 import json
+import gzip
+import base64
 from urllib.parse import urlparse, parse_qs
 import socket
+import sys
+import os
+import re
+import time
+import bisect
+import heapq
+import pickle
+import threading
+
+NONZERO = re.compile(b'[^\x00]')
+BIT_POSITIONS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+MAX_PIECES = 1 << 24
+# Most pieces one announce may carry: a 100 GiB torrent at the client's 100 KiB piece size.
+MAX_ANNOUNCED_PIECES = 1 << 20
 
 class TrackerHTTPServer(BaseHTTPRequestHandler):
+    # registry[file_name]['peers'] maps an interned peer id to a bitfield of
+    # the pieces that peer holds, and registry[file_name]['holders'] maps a
+    # piece index to an int with one bit set per holding peer. Holder bits are
+    # slots numbered per file: 'slots' maps a slot to its peer id, 'slot_of'
+    # the other way, and 'free' is a heap of slots left by removed peers, so
+    # masks stay as narrow as the file's own swarm.
+    # last_seen maps a peer id to the time of its latest announce or
+    # heartbeat; peers silent for longer than peer_ttl are expired.
     registry = {}
+    peer_ids = {}
+    peer_addresses = []
+    peer_files = {}
+    last_seen = {}
+    peer_ttl = 90
+    # catalog is the sorted list of every torrent and nested file name, and
+    # catalog_trigrams maps each lowercase trigram to the names containing it.
+    catalog = []
+    catalog_trigrams = {}
+    registry_lock = threading.Lock()
+    store = None
+
+    @classmethod
+    def intern_peer(cls, peer_ip, peer_port):
+        value = (peer_ip, peer_port)
+        if value not in cls.peer_ids:
+            cls.peer_ids[value] = len(cls.peer_addresses)
+            cls.peer_addresses.append(value)
+        return cls.peer_ids[value]
+
+    @staticmethod
+    def new_file():
+        return {"peers": {}, "holders": {}, "slots": [], "slot_of": {}, "free": [], "files_nested": []}
+
+    @classmethod
+    def peer_slot(cls, file_data, peer_id):
+        slot = file_data['slot_of'].get(peer_id)
+        if slot is None:
+            if file_data['free']:
+                slot = heapq.heappop(file_data['free'])
+                file_data['slots'][slot] = peer_id
+            else:
+                slot = len(file_data['slots'])
+                file_data['slots'].append(peer_id)
+            file_data['slot_of'][peer_id] = slot
+        return slot
+
+    @classmethod
+    def rebuild_holders(cls, file_data):
+        # Snapshots written before per-file slots used global peer ids as holder bits.
+        peers = file_data['peers']
+        file_data.update(cls.new_file(), peers={}, files_nested=file_data['files_nested'])
+        for peer_id, bitfield in peers.items():
+            peer_bit = 1 << cls.peer_slot(file_data, peer_id)
+            file_data['peers'][peer_id] = bitfield
+            for match in NONZERO.finditer(bitfield):
+                base = match.start() * 8
+                for bit in BIT_POSITIONS[bitfield[match.start()]]:
+                    index = base + 7 - bit
+                    file_data['holders'][index] = file_data['holders'].get(index, 0) | peer_bit
+
+    @classmethod
+    def add_pieces(cls, file_name, peer_ip, peer_port, pieces_indices):
+        file_data = cls.registry[file_name]
+        peer_id = cls.intern_peer(peer_ip, peer_port)
+        peer_bit = 1 << cls.peer_slot(file_data, peer_id)
+        cls.last_seen[peer_id] = time.time()
+        cls.peer_files.setdefault(peer_id, set()).add(file_name)
+        bitfield = file_data['peers'].setdefault(peer_id, bytearray())
+        holders = file_data['holders']
+        for index in pieces_indices:
+            if index < 0:
+                continue
+            if index >> 3 >= len(bitfield):
+                bitfield.extend(bytes((index >> 3) + 1 - len(bitfield)))
+            if not bitfield[index >> 3] & (0x80 >> (index & 7)):
+                bitfield[index >> 3] |= 0x80 >> (index & 7)
+                holders[index] = holders.get(index, 0) | peer_bit
+
+    @classmethod
+    def index_name(cls, name):
+        position = bisect.bisect_left(cls.catalog, name)
+        if position < len(cls.catalog) and cls.catalog[position] == name:
+            return
+        cls.catalog.insert(position, name)
+        lowered = name.lower()
+        for i in range(len(lowered) - 2):
+            cls.catalog_trigrams.setdefault(lowered[i:i + 3], set()).add(name)
+
+    @classmethod
+    def rebuild_catalog(cls):
+        cls.catalog = []
+        cls.catalog_trigrams = {}
+        for file_name, file_data in cls.registry.items():
+            cls.index_name(file_name)
+            for each in file_data['files_nested']:
+                cls.index_name(each['name'])
+
+    @classmethod
+    def search_catalog(cls, prefix='', search='', cursor='', limit=100):
+        # Names come back in sorted order, starting after cursor.
+        if search:
+            lowered = search.lower()
+            if len(lowered) >= 3:
+                postings = sorted((cls.catalog_trigrams.get(lowered[i:i + 3], set()) for i in range(len(lowered) - 2)), key=len)
+                candidates = sorted(name for name in postings[0].intersection(*postings[1:]) if name > cursor and name.startswith(prefix))
+            else:
+                start = max(bisect.bisect_right(cls.catalog, cursor) if cursor else 0, bisect.bisect_left(cls.catalog, prefix))
+                candidates = (cls.catalog[i] for i in range(start, len(cls.catalog)))
+            names = []
+            for name in candidates:
+                if prefix and not name.startswith(prefix):
+                    if name > prefix:
+                        break
+                    continue
+                if lowered in name.lower():
+                    names.append(name)
+                    if len(names) > limit:
+                        break
+        else:
+            start = max(bisect.bisect_right(cls.catalog, cursor) if cursor else 0, bisect.bisect_left(cls.catalog, prefix))
+            names = []
+            for name in cls.catalog[start:start + limit + 1]:
+                if not name.startswith(prefix):
+                    break
+                names.append(name)
+        return names[:limit], names[limit - 1] if len(names) > limit else None
+
+    @classmethod
+    def apply(cls, op, file_name, peer_ip, peer_port, pieces_indices, file_details=None):
+        # Callers hold registry_lock. Returns False for a download of an unknown file.
+        if op == 'announce':
+            if file_name not in cls.registry:
+                cls.registry[file_name] = cls.new_file()
+            cls.add_pieces(file_name, peer_ip, peer_port, pieces_indices)
+            cls.index_name(file_name)
+            if file_details:
+                cls.registry[file_name]['files_nested'] = file_details
+                for each in file_details:
+                    cls.index_name(each['name'])
+        elif op == 'download':
+            if file_name not in cls.registry:
+                return False
+            cls.add_pieces(file_name, peer_ip, peer_port, pieces_indices)
+        elif op == 'expire':
+            cls.remove_peer(cls.intern_peer(peer_ip, peer_port))
+        if cls.store:
+            cls.store.append(op, file_name, peer_ip, peer_port, pieces_indices, file_details)
+            if cls.store.pending >= cls.store.snapshot_every:
+                cls.store.snapshot(cls)
+        return True
+
+    @classmethod
+    def remove_peer(cls, peer_id):
+        for file_name in cls.peer_files.pop(peer_id, ()):
+            file_data = cls.registry[file_name]
+            slot = file_data['slot_of'].pop(peer_id)
+            file_data['slots'][slot] = None
+            heapq.heappush(file_data['free'], slot)
+            peer_bit = 1 << slot
+            bitfield = file_data['peers'].pop(peer_id, bytearray())
+            holders = file_data['holders']
+            for match in NONZERO.finditer(bitfield):
+                base = match.start() * 8
+                for bit in BIT_POSITIONS[bitfield[match.start()]]:
+                    index = base + 7 - bit
+                    mask = holders.get(index, 0) & ~peer_bit
+                    if mask:
+                        holders[index] = mask
+                    else:
+                        holders.pop(index, None)
+        cls.last_seen.pop(peer_id, None)
+
+    @classmethod
+    def expire_peers(cls, now=None):
+        now = time.time() if now is None else now
+        with cls.registry_lock:
+            stale = [peer_id for peer_id, seen in cls.last_seen.items() if now - seen > cls.peer_ttl]
+            for peer_id in stale:
+                peer_ip, peer_port = cls.peer_addresses[peer_id]
+                cls.apply('expire', None, peer_ip, peer_port, [])
+        for peer_id in stale:
+            print(f"Expired {cls.peer_addresses[peer_id][0]}:{cls.peer_addresses[peer_id][1]} after {cls.peer_ttl}s without an announce")
+        return len(stale)
+
+    @classmethod
+    def recently_seen_first(cls, peer_ids):
+        return sorted(peer_ids, key=lambda peer_id: cls.last_seen.get(peer_id, 0), reverse=True)
+
+    def parse_ranges(self, text):
+        # "0-99,105,200-300": comma separated piece indices and inclusive ranges.
+        ranges = []
+        for part in text.split(','):
+            if not part:
+                continue
+            start, _, end = part.partition('-')
+            start = int(start)
+            end = int(end) if end else start
+            if start < 0 or end < start or end >= MAX_PIECES:
+                raise ValueError(f"Invalid piece range {part}")
+            ranges.append((start, end))
+        return ranges
+
+    def announced_pieces(self, data):
+        # Counted before anything is expanded, so one request cannot hold registry_lock over millions of pieces.
+        if 'piece_ranges' in data:
+            ranges = self.parse_ranges(data['piece_ranges'])
+            if sum(end - start + 1 for start, end in ranges) > MAX_ANNOUNCED_PIECES:
+                raise ValueError(f"More than {MAX_ANNOUNCED_PIECES} pieces announced")
+            return [index for start, end in ranges for index in range(start, end + 1)]
+        pieces_indices = data['pieces_indices']
+        if len(pieces_indices) > MAX_ANNOUNCED_PIECES:
+            raise ValueError(f"More than {MAX_ANNOUNCED_PIECES} pieces announced")
+        if any(not 0 <= index < MAX_PIECES for index in pieces_indices):
+            raise ValueError("Invalid piece indices")
+        return pieces_indices
+
+    def send_json(self, data, indent=None):
+        body = json.dumps(data, indent=indent).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        if len(body) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 5)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def do_POST(self):
         if self.path == '/peer-update':
@@ -15,26 +257,20 @@ class TrackerHTTPServer(BaseHTTPRequestHandler):
             file_name = data['file_name']
             peer_ip = data['peer_ip']
             peer_port = data['peer_port']
-            pieces_indices = data['pieces_indices']
+            try:
+                pieces_indices = self.announced_pieces(data)
+            except (ValueError, TypeError):
+                self.send_error(400, "Invalid piece indices")
+                return
             file_details = data.get('file_details', None)
-            if file_name not in self.registry:
-                self.registry[file_name] = {
-                    "piece_indices": {},
-                    "files_nested": []
-                }
-            for index in pieces_indices:
-                if index not in self.registry[file_name]["piece_indices"]:
-                    self.registry[file_name]["piece_indices"][index] = []
-                if (peer_ip, peer_port) not in self.registry[file_name]["piece_indices"][index]:
-                    self.registry[file_name]["piece_indices"][index].append((peer_ip, peer_port))
-            if file_details:
-                self.registry[file_name]['files_nested'] = file_details
+            with self.registry_lock:
+                self.apply('announce', file_name, peer_ip, peer_port, pieces_indices, file_details)
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
             response = {"message": "Update successful"}
             self.wfile.write(json.dumps(response).encode())
-            print(self.registry)
+            print(f"{peer_ip}:{peer_port} announced {len(pieces_indices)} pieces of {file_name}")
         elif self.path == '/peer-update-download':
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
@@ -43,62 +279,255 @@ class TrackerHTTPServer(BaseHTTPRequestHandler):
             peer_ip = data['peer_ip']
             peer_port = data['peer_port']
             file_name = data['file_name']
-            pieces_indices = data['pieces_indices']
-            for index in pieces_indices:
-                if (peer_ip, peer_port) not in self.registry[file_name]["piece_indices"][index]:
-                    self.registry[file_name]["piece_indices"][index].append((peer_ip, peer_port))
+            try:
+                pieces_indices = self.announced_pieces(data)
+            except (ValueError, TypeError):
+                self.send_error(400, "Invalid piece indices")
+                return
+            with self.registry_lock:
+                known = self.apply('download', file_name, peer_ip, peer_port, pieces_indices)
+            if not known:
+                self.send_error(404, "File Not Found")
+                return
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
             response = {"message": "Update successful"}
             self.wfile.write(json.dumps(response).encode())
-            print(self.registry)
+            print(f"{peer_ip}:{peer_port} downloaded {len(pieces_indices)} pieces of {file_name}")
+        elif self.path == '/heartbeat':
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            data = json.loads(post_data.decode())
+
+            with self.registry_lock:
+                peer_id = self.peer_ids.get((data['peer_ip'], data['peer_port']))
+                known = peer_id in self.last_seen
+                if known:
+                    self.last_seen[peer_id] = time.time()
+            if not known:
+                # Expired or never announced: the peer has to announce its pieces again.
+                self.send_error(404, "Peer Not Found")
+                return
+            self.send_json({"message": "Heartbeat received", "ttl": self.peer_ttl})
+        else:
+            self.send_error(404, "File Not Found")
 
     def do_GET(self):
-        if self.path == '/show':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            temp = []
-            for key in self.registry.keys():
-                if(len(self.registry[key]['files_nested'])):
-                    for each in self.registry[key]['files_nested']:
-                        temp.append(each['name'])
-                temp.append(key)
-            self.wfile.write(json.dumps({'files':  temp}, indent=4).encode('utf-8'))
+        if self.path == '/show' or self.path.startswith('/show?'):
+            query_components = parse_qs(urlparse(self.path).query)
+            prefix = query_components.get('prefix', [''])[0]
+            search = query_components.get('search', [''])[0]
+            cursor = query_components.get('cursor', [''])[0]
+            try:
+                limit = min(max(int(query_components.get('limit', ['100'])[0]), 1), 1000)
+            except ValueError:
+                self.send_error(400, "Invalid limit")
+                return
+            with self.registry_lock:
+                temp, next_cursor = self.search_catalog(prefix, search, cursor, limit)
+            self.send_json({'files':  temp, 'next_cursor': next_cursor}, indent=4)
         elif self.path.startswith('/get-peer'): 
             query_components = parse_qs(urlparse(self.path).query)
             piece_indices = query_components.get('piece_indices', [''])[0]
+            piece_ranges = query_components.get('piece_ranges', [None])[0]
             filename = query_components.get('filename', [''])[0]
-            print('INDEX: ', piece_indices)
+            compact = query_components.get('format', [''])[0] == 'compact'
+            print('INDEX: ', piece_ranges if piece_ranges is not None else piece_indices)
             print('NAME: ', filename)
             try:
-                piece_indices = [int(index) for index in piece_indices.split(',')]
+                if piece_ranges is not None:
+                    ranges = self.parse_ranges(piece_ranges)
+                else:
+                    piece_indices = [int(index) for index in piece_indices.split(',')]
+                    ranges = [(index, index) for index in piece_indices if index >= 0]
             except ValueError:
                 self.send_error(400, "Invalid piece indices")
                 return
-            response_data = self.find_peers_by_piece_indices(filename, piece_indices)
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(response_data).encode('utf-8'))
+            if compact:
+                response_data = self.find_peers_compact(filename, ranges)
+            elif piece_ranges is not None:
+                response_data = self.find_peers_by_piece_ranges(filename, ranges)
+            else:
+                response_data = self.find_peers_by_piece_indices(filename, piece_indices)
+            self.send_json(response_data)
         else:
             self.send_error(404, "File Not Found")
 
     def find_peers_by_piece_indices(self, filename, piece_indices):
-        file_data = self.registry.get(filename, {})
-        pieces_info = file_data.get('piece_indices', {})
-        result = {index: pieces_info.get(index, []) for index in piece_indices}
+        result = {}
+        decoded = {0: []}
+        with self.registry_lock:
+            file_data = self.registry.get(filename, {})
+            holders = file_data.get('holders', {})
+            slots = file_data.get('slots', [])
+            for index in piece_indices:
+                mask = holders.get(index, 0)
+                if mask not in decoded:
+                    peer_ids = []
+                    data = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+                    for match in NONZERO.finditer(data):
+                        base = match.start() * 8
+                        for bit in BIT_POSITIONS[data[match.start()]]:
+                            peer_ids.append(slots[base + bit])
+                    decoded[mask] = [self.peer_addresses[peer_id] for peer_id in self.recently_seen_first(peer_ids)]
+                result[index] = list(decoded[mask])
         return result
 
+    def find_peers_by_piece_ranges(self, filename, ranges):
+        # Ranges are clipped to the highest piece any peer announced.
+        with self.registry_lock:
+            known = max((len(bitfield) for bitfield in self.registry.get(filename, {}).get('peers', {}).values()), default=0) * 8
+        return self.find_peers_by_piece_indices(filename, [index for start, end in ranges for index in range(start, min(end, known - 1) + 1)])
+
+    def find_peers_compact(self, filename, ranges):
+        # Each holder is listed once with a base64 bitfield of the requested
+        # pieces it has, bit 0x80 of the first byte being piece 0.
+        peers = []
+        with self.registry_lock:
+            file_bitfields = self.registry.get(filename, {}).get('peers', {})
+            size = max((len(bitfield) for bitfield in file_bitfields.values()), default=0)
+            mask = 0
+            for start, end in ranges:
+                end = min(end, size * 8 - 1)
+                if start <= end:
+                    mask |= ((1 << (end - start + 1)) - 1) << (size * 8 - 1 - end)
+            for peer_id in self.recently_seen_first(file_bitfields):
+                bitfield = file_bitfields[peer_id]
+                common = int.from_bytes(bytes(bitfield).ljust(size, b'\0'), 'big') & mask
+                if common:
+                    peer_ip, peer_port = self.peer_addresses[peer_id]
+                    peers.append([peer_ip, peer_port, base64.b64encode(common.to_bytes(size, 'big').rstrip(b'\0')).decode()])
+        return {'pieces': size * 8, 'peers': peers}
+
+
+class TrackerStore:
+    # Every registry change is appended to announces.log as one JSON line.
+    # Every snapshot_every changes the whole registry is pickled to
+    # snapshot.pickle and the log starts over, so a restart loads the
+    # snapshot and replays at most snapshot_every lines.
+    def __init__(self, path, snapshot_every=10000):
+        self.path = path
+        self.snapshot_path = os.path.join(path, 'snapshot.pickle')
+        self.log_path = os.path.join(path, 'announces.log')
+        self.snapshot_every = snapshot_every
+        self.pending = 0
+        self.log = None
+
+    def encode_ranges(self, indices):
+        ranges = []
+        for index in sorted(set(indices)):
+            if ranges and ranges[-1][1] == index - 1:
+                ranges[-1][1] = index
+            else:
+                ranges.append([index, index])
+        return ','.join(f"{start}-{end}" if end > start else str(start) for start, end in ranges)
+
+    def decode_ranges(self, text):
+        indices = []
+        for part in text.split(','):
+            if part:
+                start, _, end = part.partition('-')
+                indices.extend(range(int(start), int(end or start) + 1))
+        return indices
+
+    def load(self, handler_class):
+        start = time.perf_counter()
+        os.makedirs(self.path, exist_ok=True)
+        handler_class.store = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as f:
+                state = pickle.load(f)
+            handler_class.registry = state['registry']
+            handler_class.peer_ids = state['peer_ids']
+            handler_class.peer_addresses = state['peer_addresses']
+        # Recovered peers get a full TTL from now to send their next heartbeat.
+        handler_class.peer_files = {}
+        handler_class.last_seen = {}
+        now = time.time()
+        for file_name, file_data in handler_class.registry.items():
+            if 'slots' not in file_data:
+                handler_class.rebuild_holders(file_data)
+            for peer_id in file_data['peers']:
+                handler_class.peer_files.setdefault(peer_id, set()).add(file_name)
+                handler_class.last_seen[peer_id] = now
+        handler_class.rebuild_catalog()
+        replayed = 0
+        valid = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("Unterminated log entry")
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A write cut short by a crash; everything after it is dropped.
+                        break
+                    handler_class.apply(entry['op'], entry['file_name'], entry['peer_ip'], entry['peer_port'], self.decode_ranges(entry['piece_ranges']), entry.get('file_details'))
+                    replayed += 1
+                    valid += len(line)
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(valid)
+        self.pending = replayed
+        self.log = open(self.log_path, 'ab')
+        handler_class.store = self
+        print(f"Recovered {len(handler_class.registry)} files and {len(handler_class.peer_addresses)} peers from {self.path} ({replayed} log entries) in {time.perf_counter() - start:.3f}s")
 
-def run(server_class=HTTPServer, handler_class=TrackerHTTPServer, port=8000):
+    def append(self, op, file_name, peer_ip, peer_port, pieces_indices, file_details=None):
+        entry = {'op': op, 'file_name': file_name, 'peer_ip': peer_ip, 'peer_port': peer_port, 'piece_ranges': self.encode_ranges(pieces_indices)}
+        if file_details:
+            entry['file_details'] = file_details
+        self.log.write(json.dumps(entry).encode() + b'\n')
+        self.log.flush()
+        self.pending += 1
+
+    def snapshot(self, handler_class):
+        state = {'registry': handler_class.registry, 'peer_ids': handler_class.peer_ids, 'peer_addresses': handler_class.peer_addresses}
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        # A crash before this truncate only replays entries the snapshot already holds.
+        self.log.truncate(0)
+        self.pending = 0
+
+    def close(self, handler_class):
+        with handler_class.registry_lock:
+            if self.pending:
+                self.snapshot(handler_class)
+            self.log.close()
+            handler_class.store = None
+
+
+class ThreadedTrackerServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+
+
+def run(server_class=ThreadedTrackerServer, handler_class=TrackerHTTPServer, port=8000, state_path='tracker_state'):
     host_name = socket.gethostname()
     ip = socket.gethostbyname(host_name)
     server_address = (ip, port)
+    store = TrackerStore(state_path)
+    store.load(handler_class)
     httpd = server_class(server_address, handler_class)
+
+    def expire():
+        while True:
+            time.sleep(handler_class.peer_ttl / 4)
+            handler_class.expire_peers()
+    threading.Thread(target=expire, daemon=True).start()
     print(f"Starting httpd server on port {port}")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        store.close(handler_class)
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    state_path = sys.argv[sys.argv.index('--state') + 1] if '--state' in sys.argv else 'tracker_state'
+    run(HTTPServer if '--single' in sys.argv else ThreadedTrackerServer, state_path=state_path)
\ No newline at end of file
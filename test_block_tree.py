@@ -0,0 +1,71 @@
+import hashlib
+import pytest
+from c import BlockTree, Peer
+
+BLOCK = 16
+
+
+def tree_for(count):
+    data = bytes(range(count * BLOCK))
+    return data, BlockTree(BlockTree.leaves(data, BLOCK))
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 5])
+def test_every_block_verifies_against_the_root(count):
+    data, tree = tree_for(count)
+    for index in range(count):
+        leaf = hashlib.sha1(data[index * BLOCK:(index + 1) * BLOCK]).digest()
+        assert BlockTree.verify(leaf, index, count, tree.proof(index), tree.root)
+
+
+def test_unpaired_node_is_carried_up_without_a_sibling():
+    data, tree = tree_for(5)
+    # Block 4 has no sibling on the first two levels, so its only proof node is the root of blocks 0-3.
+    assert tree.proof(4) == [tree.levels[2][0]]
+    assert len(tree.proof(0)) == 3
+
+
+@pytest.mark.parametrize('count', [2, 3, 5])
+def test_flipped_block_is_rejected(count):
+    data, tree = tree_for(count)
+    for index in range(count):
+        block = bytearray(data[index * BLOCK:(index + 1) * BLOCK])
+        block[0] ^= 1
+        assert not BlockTree.verify(hashlib.sha1(block).digest(), index, count, tree.proof(index), tree.root)
+
+
+@pytest.mark.parametrize('count', [2, 3, 5])
+def test_wrong_index_is_rejected(count):
+    data, tree = tree_for(count)
+    leaf = hashlib.sha1(data[:BLOCK]).digest()
+    for index in range(1, count + 1):
+        assert not BlockTree.verify(leaf, index, count, tree.proof(0), tree.root)
+    assert not BlockTree.verify(leaf, -1, count, tree.proof(0), tree.root)
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 5])
+def test_short_or_long_proof_is_rejected(count):
+    data, tree = tree_for(count)
+    for index in range(count):
+        leaf = hashlib.sha1(data[index * BLOCK:(index + 1) * BLOCK]).digest()
+        proof = tree.proof(index)
+        if proof:
+            assert not BlockTree.verify(leaf, index, count, proof[:-1], tree.root)
+        assert not BlockTree.verify(leaf, index, count, proof + [tree.root], tree.root)
+
+
+def test_check_block_penalises_a_corrupt_block(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    peer = Peer()
+    peer.handle_file.block_size = BLOCK
+    data = bytes(range(5 * BLOCK))
+    (tmp_path / 'movie').write_bytes(data)
+    peer.store.add_torrent('movie', len(data), [(str(tmp_path / 'movie'), len(data))])
+    root = BlockTree(BlockTree.leaves(data, BLOCK)).root.hex()
+    for offset in range(0, len(data), BLOCK):
+        peer.check_block('10.0.0.1', 5000, 'movie', 0, offset, data[offset:offset + BLOCK], peer.block_proof('movie', 0, offset), root)
+    block = bytearray(data[2 * BLOCK:3 * BLOCK])
+    block[-1] ^= 0xFF
+    with pytest.raises(ValueError):
+        peer.check_block('10.0.0.1', 5000, 'movie', 0, 2 * BLOCK, block, peer.block_proof('movie', 0, 2 * BLOCK), root)
+    assert peer.peer_penalties[('10.0.0.1', 5000)] == 1
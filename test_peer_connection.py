@@ -0,0 +1,103 @@
+import asyncio
+import socket
+import threading
+import pytest
+from c import AsyncPeer, AsyncPeerConnection, Peer, PeerConnection, PeerProtocol
+
+
+@pytest.fixture
+def silent_peer():
+    # The far end of the pair never answers, like a peer that went quiet after HELLO.
+    ours, theirs = socket.socketpair()
+    yield ours
+    theirs.close()
+
+
+@pytest.fixture
+def peer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    peer = Peer()
+    peer.request_timeout = 0.2
+    return peer
+
+
+def test_full_pipeline_times_out_instead_of_blocking(silent_peer):
+    connection = PeerConnection(silent_peer, PeerProtocol(silent_peer), 2, timeout=0.2)
+    for index in range(2):
+        connection.request(PeerProtocol.BLOCK, index, payload=b'movie')
+    with pytest.raises(TimeoutError):
+        connection.request(PeerProtocol.BLOCK, 2, payload=b'movie')
+    connection.close()
+
+
+def test_request_timeout_closes_connection_and_frees_slots(silent_peer, peer):
+    connection = PeerConnection(silent_peer, PeerProtocol(silent_peer), peer.pipeline_depth, peer.request_timeout)
+    peer.connections.connections[('127.0.0.1', 5000)] = connection
+    futures = []
+    for index in range(peer.pipeline_depth - 1):
+        futures.append(connection.request(PeerProtocol.BLOCK, index, payload=b'movie'))
+    with pytest.raises(TimeoutError):
+        peer.request_block('127.0.0.1', 5000, 'movie', 9, 0, 16, root='')
+    assert connection.closed
+    assert not connection.pending
+    assert all(isinstance(future.exception(timeout=1), ConnectionError) for future in futures)
+    for _ in range(peer.pipeline_depth):
+        assert connection.slots.acquire(timeout=0)
+
+
+def test_async_request_timeout_closes_connection(silent_peer, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    peer = AsyncPeer()
+    peer.request_timeout = 0.2
+
+    async def fetch():
+        await peer.prepare()
+        reader, writer = await asyncio.open_connection(sock=silent_peer)
+        connection = AsyncPeerConnection(reader, writer, PeerProtocol(None), peer.pipeline_depth)
+        peer.async_connections[('127.0.0.1', 5000)] = connection
+        peer.peer_versions[('127.0.0.1', 5000)] = PeerProtocol.VERSION
+        result = await peer.fetch_block('movie', 9, 0, 16, [('127.0.0.1', 5000)])
+        return connection, result
+
+    connection, result = asyncio.run(fetch())
+    assert result == (None, None)
+    assert connection.closed
+    assert not connection.pending
+
+
+def test_undecodable_file_name_gets_an_error_frame(peer):
+    ours, theirs = socket.socketpair()
+    thread = threading.Thread(target=peer.handle_binary_client, args=(theirs,), daemon=True)
+    thread.start()
+    protocol = PeerProtocol(ours)
+    protocol.send(PeerProtocol.BLOCK, 3, payload=b'\xff\xfe')
+    assert protocol.recv()['type'] == PeerProtocol.ERROR
+    protocol.send(PeerProtocol.HELLO)
+    assert protocol.recv()['type'] == PeerProtocol.HELLO
+    ours.close()
+    thread.join(1)
+    assert not thread.is_alive()
+
+
+def test_async_undecodable_file_name_gets_an_error_frame(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    peer = AsyncPeer()
+    ours, theirs = socket.socketpair()
+
+    async def serve():
+        await peer.prepare()
+        reader, writer = await asyncio.open_connection(sock=theirs)
+        task = asyncio.ensure_future(peer.handle_connection(reader, writer))
+        client_reader, client_writer = await asyncio.open_connection(sock=ours)
+        protocol = PeerProtocol(None)
+        client_writer.write(protocol.pack(PeerProtocol.BLOCK, 3, payload_length=2) + b'\xff\xfe')
+        error = await asyncio.wait_for(AsyncPeerConnection.read_frame(client_reader), 1)
+        client_writer.write(protocol.pack(PeerProtocol.HELLO))
+        hello = await asyncio.wait_for(AsyncPeerConnection.read_frame(client_reader), 1)
+        client_writer.close()
+        await asyncio.wait_for(task, 1)
+        return error, hello
+
+    error, hello = asyncio.run(serve())
+    assert error['type'] == PeerProtocol.ERROR
+    assert hello['type'] == PeerProtocol.HELLO
@@ -0,0 +1,124 @@
+import os
+import pytest
+from t import TrackerHTTPServer, TrackerStore
+
+STATE = ('registry', 'peer_ids', 'peer_addresses', 'peer_files', 'last_seen', 'catalog', 'catalog_trigrams', 'store')
+
+
+@pytest.fixture
+def tracker():
+    saved = {name: getattr(TrackerHTTPServer, name) for name in STATE}
+    reset()
+    yield TrackerHTTPServer
+    if TrackerHTTPServer.store:
+        TrackerHTTPServer.store.log.close()
+    for name, value in saved.items():
+        setattr(TrackerHTTPServer, name, value)
+
+
+def reset():
+    TrackerHTTPServer.registry = {}
+    TrackerHTTPServer.peer_ids = {}
+    TrackerHTTPServer.peer_addresses = []
+    TrackerHTTPServer.peer_files = {}
+    TrackerHTTPServer.last_seen = {}
+    TrackerHTTPServer.catalog = []
+    TrackerHTTPServer.catalog_trigrams = {}
+    TrackerHTTPServer.store = None
+
+
+def swarm(cls):
+    # Which address holds which pieces, read from both the per-peer bitfields
+    # and the per-piece holder masks, so slot numbering does not matter.
+    state = {}
+    for file_name, file_data in cls.registry.items():
+        by_peer = {cls.peer_addresses[peer_id]: bytes(bitfield).rstrip(b'\0') for peer_id, bitfield in file_data['peers'].items()}
+        by_piece = {}
+        for index, mask in file_data['holders'].items():
+            by_piece[index] = {cls.peer_addresses[file_data['slots'][slot]] for slot in range(mask.bit_length()) if mask >> slot & 1}
+        state[file_name] = (by_peer, by_piece, file_data['files_nested'])
+    return state
+
+
+def reload(path, **kwargs):
+    if TrackerHTTPServer.store:
+        TrackerHTTPServer.store.log.close()
+    reset()
+    store = TrackerStore(path, **kwargs)
+    store.load(TrackerHTTPServer)
+    return store
+
+
+def announce(cls, *ops):
+    with cls.registry_lock:
+        for op in ops:
+            cls.apply(*op)
+
+
+def test_snapshot_and_log_replay_match_live_registry(tracker, tmp_path):
+    reload(str(tmp_path), snapshot_every=4)
+    announce(tracker,
+             ('announce', 'movie', '10.0.0.1', 5000, list(range(10)), [{'name': 'movie/a.mkv', 'length': 10}]),
+             ('announce', 'movie', '10.0.0.2', 5000, [1, 3, 5]),
+             ('download', 'movie', '10.0.0.3', 5001, [0, 9]),
+             ('announce', 'music', '10.0.0.2', 5000, [0, 100]),
+             ('expire', None, '10.0.0.1', 5000, []),
+             ('download', 'movie', '10.0.0.2', 5000, [7]))
+    assert os.path.getsize(tmp_path / 'snapshot.pickle') > 0
+    assert len((tmp_path / 'announces.log').read_bytes().splitlines()) == 2
+    live = swarm(tracker)
+    catalog = list(tracker.catalog)
+    reload(str(tmp_path), snapshot_every=4)
+    assert swarm(tracker) == live
+    assert tracker.catalog == catalog
+    assert ('10.0.0.1', 5000) not in live['movie'][0]
+
+
+def test_torn_last_line_is_truncated(tracker, tmp_path):
+    reload(str(tmp_path))
+    announce(tracker, ('announce', 'movie', '10.0.0.1', 5000, [0, 1, 2]), ('announce', 'movie', '10.0.0.2', 5000, [2]))
+    live = swarm(tracker)
+    log_path = tmp_path / 'announces.log'
+    valid = log_path.read_bytes()
+    with open(log_path, 'ab') as f:
+        f.write(b'{"op": "announce", "file_name": "mov')
+    reload(str(tmp_path))
+    assert swarm(tracker) == live
+    assert log_path.read_bytes() == valid
+    announce(tracker, ('download', 'movie', '10.0.0.3', 5000, [1]))
+    reload(str(tmp_path))
+    assert swarm(tracker)['movie'][1][1] == {('10.0.0.1', 5000), ('10.0.0.3', 5000)}
+
+
+def test_crash_between_snapshot_and_log_truncate_is_idempotent(tracker, tmp_path):
+    store = reload(str(tmp_path))
+    announce(tracker,
+             ('announce', 'movie', '10.0.0.1', 5000, [0, 1]),
+             ('announce', 'movie', '10.0.0.2', 5000, [1, 2]),
+             ('expire', None, '10.0.0.1', 5000, []),
+             ('announce', 'movie', '10.0.0.1', 5000, [3]),
+             ('download', 'movie', '10.0.0.2', 5000, [4]))
+    live = swarm(tracker)
+    log_path = tmp_path / 'announces.log'
+    entries = log_path.read_bytes()
+    # The snapshot replaced the old one, but the log was never truncated.
+    with tracker.registry_lock:
+        store.snapshot(tracker)
+    log_path.write_bytes(entries)
+    reload(str(tmp_path))
+    assert swarm(tracker) == live
+
+
+def test_expire_is_replayed(tracker, tmp_path):
+    reload(str(tmp_path))
+    announce(tracker,
+             ('announce', 'movie', '10.0.0.1', 5000, [0, 1]),
+             ('announce', 'movie', '10.0.0.2', 5000, [1]),
+             ('announce', 'music', '10.0.0.1', 5000, [0]))
+    tracker.last_seen[tracker.peer_ids[('10.0.0.1', 5000)]] = 0
+    assert tracker.expire_peers(now=tracker.peer_ttl + 1) == 1
+    live = swarm(tracker)
+    assert live['movie'][1] == {1: {('10.0.0.2', 5000)}}
+    reload(str(tmp_path))
+    assert swarm(tracker) == live
+    assert tracker.peer_files == {tracker.peer_ids[('10.0.0.2', 5000)]: {'movie'}}
@@ -0,0 +1,150 @@
+import sys
+import json
+
+DIGEST_SIZE = 20
+DIGITS = frozenset(b'0123456789')
+
+class PieceHashes:
+    # Raw 20 byte SHA-1 digests back to back, as stored in a binary torrent.
+    def __init__(self, digests):
+        if len(digests) % DIGEST_SIZE:
+            raise ValueError(f"Pieces length {len(digests)} is not a multiple of {DIGEST_SIZE}")
+        self.digests = memoryview(digests)
+
+    @classmethod
+    def from_hex(cls, pieces):
+        return cls(bytes.fromhex(pieces))
+
+    def __len__(self):
+        return len(self.digests) // DIGEST_SIZE
+
+    def digest(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(f"Piece {index} out of range")
+        return self.digests[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE].tobytes()
+
+    def __getitem__(self, index):
+        return self.digest(index).hex()
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def hex(self):
+        return self.digests.hex()
+
+
+def bencode(value, out=None):
+    out = bytearray() if out is None else out
+    if isinstance(value, bool) or value is None:
+        raise TypeError(f"Cannot bencode {value!r}")
+    if isinstance(value, int):
+        out += b'i%de' % value
+    elif isinstance(value, str):
+        value = value.encode()
+        out += b'%d:' % len(value) + value
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += b'%d:' % len(value)
+        out += value
+    elif isinstance(value, PieceHashes):
+        bencode(value.digests, out)
+    elif isinstance(value, (list, tuple)):
+        out += b'l'
+        for item in value:
+            bencode(item, out)
+        out += b'e'
+    elif isinstance(value, dict):
+        out += b'd'
+        for key in sorted(value, key=lambda key: key.encode()):
+            bencode(key, out)
+            bencode(value[key], out)
+        out += b'e'
+    else:
+        raise TypeError(f"Cannot bencode {type(value).__name__}")
+    return out
+
+
+def bdecode(data, raw_keys=('pieces',)):
+    # Strings are returned as str, except values under raw_keys, which stay
+    # memoryview slices of data so large digests are never copied.
+    data = memoryview(data)
+    value, end = decode_value(data, 0, raw_keys, False)
+    if end != len(data):
+        raise ValueError(f"Trailing data at offset {end}")
+    return value
+
+
+def decode_value(data, pos, raw_keys, raw):
+    kind = data[pos]
+    if kind == ord('i'):
+        end = bytes(data[pos + 1:pos + 32]).index(b'e') + pos + 1
+        return int(bytes(data[pos + 1:end])), end + 1
+    if kind == ord('l'):
+        items = []
+        pos += 1
+        while data[pos] != ord('e'):
+            item, pos = decode_value(data, pos, raw_keys, False)
+            items.append(item)
+        return items, pos + 1
+    if kind == ord('d'):
+        items = {}
+        pos += 1
+        while data[pos] != ord('e'):
+            key, pos = decode_value(data, pos, raw_keys, False)
+            items[key], pos = decode_value(data, pos, raw_keys, key in raw_keys)
+        return items, pos + 1
+    if kind in DIGITS:
+        colon = bytes(data[pos:pos + 32]).index(b':') + pos
+        start = colon + 1
+        end = start + int(bytes(data[pos:colon]))
+        if end > len(data):
+            raise ValueError(f"String at offset {pos} runs past the end of the data")
+        return (data[start:end] if raw else str(data[start:end], 'utf-8')), end
+    raise ValueError(f"Unexpected byte {bytes([kind])!r} at offset {pos}")
+
+
+def encode_torrent(torrent_data):
+    info = dict(torrent_data['info'])
+    if isinstance(info['pieces'], str):
+        info['pieces'] = bytes.fromhex(info['pieces'])
+    return bytes(bencode({**torrent_data, 'info': info}))
+
+
+def decode_torrent(data):
+    torrent_data = bdecode(data)
+    torrent_data['info']['pieces'] = PieceHashes(torrent_data['info']['pieces'])
+    return torrent_data
+
+
+def torrent_to_json(torrent_data):
+    info = dict(torrent_data['info'])
+    if isinstance(info['pieces'], PieceHashes):
+        info['pieces'] = info['pieces'].hex()
+    return {**torrent_data, 'info': info}
+
+
+def load_torrent(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:1] == b'{':
+        torrent_data = json.loads(data)
+        torrent_data['info']['pieces'] = PieceHashes.from_hex(torrent_data['info']['pieces'])
+        return torrent_data
+    return decode_torrent(data)
+
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] not in ('binary', 'json'):
+        print("usage: python torrent.py binary <torrent.json> <out.torrent>")
+        print("       python torrent.py json <file.torrent> <out.json>")
+        return
+    torrent_data = load_torrent(sys.argv[2])
+    if sys.argv[1] == 'binary':
+        data = encode_torrent(torrent_data)
+    else:
+        data = json.dumps(torrent_to_json(torrent_data)).encode()
+    with open(sys.argv[3], 'wb') as f:
+        f.write(data)
+    print(f"\033[34mWrote {sys.argv[3]}: {len(torrent_data['info']['pieces'])} pieces, {len(data)} bytes\033[0m")
+
+if __name__ == "__main__":
+    main()